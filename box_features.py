@@ -0,0 +1,174 @@
+import numpy as np
+
+# The features used to decide if two boxes should be merged. The
+# classifier was trained on these in sorted order, so the columns of
+# the feature matrix follow the same order.
+feature_names = sorted([
+  'dist_pix',
+  'dist_perc',
+  'overlap_pix',
+  'overlap_perc',
+  'no_div_horiz_line',
+  'no_div_vert_line',
+  'ratio_of_areas_1',
+  'ratio_of_areas_2',
+  'box_1_area',
+  'box_2_area',
+  'ltr_dist',
+  'ttb_dist',
+  'no_horiz_line_in_middle',
+  'no_vert_line_in_middle',
+  'dist_bw_vert_centers',
+  'dist_bw_horiz_centers',
+  'dist_bw_lefts',
+  'dist_bw_tops',
+  'dist_bw_rights',
+  'dist_bw_bottoms',
+  'dist_trans_tb_scaled',
+  'dist_trans_lr_scaled'
+])
+
+# Upper bound on the number of pairs checked at once for lines between
+# boxes, so the temporary arrays stay bounded when every pair is scored
+max_chunk_size = 1 << 20
+
+# Returns the indices of every pair of boxes, in the same
+# order as itertools.combinations
+def get_pair_indices(num_boxes):
+  return np.triu_indices(num_boxes, 1)
+
+def get_box_array(boxes):
+  return np.array([box[:4] for box in boxes], dtype=np.float64).reshape(-1, 4)
+
+# Builds the (pairs x features) matrix for the given pairs of boxes,
+# with the same values as computing each pair on its own. Lines are
+# given as the (horizontal, vertical) pair of line_index.LineIndex, and
+# the scaled distance transform as a range_max.RangeMax
+def get_feature_matrix(boxes, line_indexes, dist_max, idx_1, idx_2):
+  coords = get_box_array(boxes)
+  box_1 = coords[idx_1]
+  box_2 = coords[idx_2]
+
+  x_1, y_1, w_1, h_1 = box_1.T
+  x_2, y_2, w_2, h_2 = box_2.T
+  right_1 = x_1 + w_1
+  right_2 = x_2 + w_2
+  bottom_1 = y_1 + h_1
+  bottom_2 = y_2 + h_2
+
+  features = {}
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    # Distance between the boxes, flat and relative to their size
+    horiz_dist = np.maximum(0, np.maximum(x_1, x_2) - np.minimum(right_1, right_2))
+    vert_dist = np.maximum(0, np.maximum(y_1, y_2) - np.minimum(bottom_1, bottom_2))
+
+    min_horiz_range = np.minimum(w_1, w_2)
+    min_vert_range = np.minimum(h_1, h_2)
+
+    dist = np.sqrt(horiz_dist ** 2 + vert_dist ** 2)
+    min_range = np.sqrt(min_horiz_range ** 2 + min_vert_range ** 2)
+
+    features['dist_pix'] = dist
+    features['dist_perc'] = dist / min_range
+
+    # Overlap, flat and relative to their size
+    horiz_over = np.maximum(0, np.minimum(right_1, right_2) - np.maximum(x_1, x_2))
+    vert_over = np.maximum(0, np.minimum(bottom_1, bottom_2) - np.maximum(y_1, y_2))
+
+    features['overlap_pix'] = horiz_over * vert_over
+    features['overlap_perc'] = horiz_over * vert_over / (min_horiz_range * min_vert_range)
+
+    # Lines between the boxes, both with and without requiring
+    # the line to overlap one of them
+    features['no_div_horiz_line'] = 1 - lines_between(box_1, box_2, line_indexes, 1)
+    features['no_div_vert_line'] = 1 - lines_between(box_1, box_2, line_indexes, 0)
+    features['no_horiz_line_in_middle'] = 1 - lines_in_middle(box_1, box_2, line_indexes, 1)
+    features['no_vert_line_in_middle'] = 1 - lines_in_middle(box_1, box_2, line_indexes, 0)
+
+    # Areas, and their ratios
+    box_1_area = w_1 * h_1
+    box_2_area = w_2 * h_2
+
+    features['ratio_of_areas_1'] = box_1_area / box_2_area
+    features['ratio_of_areas_2'] = box_2_area / box_1_area
+    features['box_1_area'] = box_1_area
+    features['box_2_area'] = box_2_area
+
+  # Left to right and top to bottom distances
+  features['ltr_dist'] = np.minimum(np.abs(x_1 - right_2), x_2 - right_1)
+  features['ttb_dist'] = np.minimum(np.abs(y_1 - bottom_2), y_2 - bottom_1)
+
+  # Distances between centers, and between each of the edges
+  features['dist_bw_vert_centers'] = np.abs((x_1 + right_1) - (x_2 + right_2)) / 2.0
+  features['dist_bw_horiz_centers'] = np.abs((y_1 + bottom_1) - (y_2 + bottom_2)) / 2.0
+  features['dist_bw_lefts'] = np.abs(x_1 - x_2)
+  features['dist_bw_tops'] = np.abs(y_1 - y_2)
+  features['dist_bw_rights'] = np.abs(right_1 - right_2)
+  features['dist_bw_bottoms'] = np.abs(bottom_1 - bottom_2)
+
+  # Distance transform features
+  features['dist_trans_tb_scaled'] = get_tb_dts(dist_max, box_1, box_2, vert_over)
+  features['dist_trans_lr_scaled'] = get_lr_dts(dist_max, box_1, box_2, horiz_over)
+
+  return np.column_stack([features[name] for name in feature_names]).reshape(-1, len(feature_names))
+
+# Whether any line lies between the two boxes along the offset axis,
+# regardless of its extent
+def lines_in_middle(box_1, box_2, line_indexes, offset):
+  index = line_indexes[(offset + 1) % 2]
+
+  # Check if box1, line, box2 and if box2, line, box1
+  is_bw_1 = index.any_between_batch(box_1[:, offset] + box_1[:, offset + 2], box_2[:, offset])
+  is_bw_2 = index.any_between_batch(box_2[:, offset] + box_2[:, offset + 2], box_1[:, offset])
+
+  return (is_bw_1 | is_bw_2).astype(np.float64)
+
+# Whether any line lies between the two boxes along the offset axis, and
+# overlaps at least one of them
+def lines_between(box_1, box_2, line_indexes, offset):
+  index = line_indexes[(offset + 1) % 2]
+  alt_offset = (offset + 1) % 2
+  found = np.zeros(len(box_1), dtype=bool)
+
+  for first in range(0, len(box_1), max_chunk_size):
+    b_1 = box_1[first:first + max_chunk_size]
+    b_2 = box_2[first:first + max_chunk_size]
+    chunk_found = found[first:first + max_chunk_size]
+
+    for near, far in ((b_1, b_2), (b_2, b_1)):
+      low = near[:, offset] + near[:, offset + 2]
+      high = far[:, offset]
+
+      for box in (b_1, b_2):
+        chunk_found |= index.any_overlapping_between_batch(low, high, box[:, alt_offset], box[:, alt_offset] + box[:, alt_offset + 2])
+
+  return found.astype(np.float64)
+
+# Distance transform maximum in the region between boxes which are
+# above and below each other (-1 if they overlap vertically)
+def get_tb_dts(dist_max, box_1, box_2, vert_over):
+  left = np.minimum(box_1[:, 0], box_2[:, 0])
+  right = np.maximum(box_1[:, 0] + box_1[:, 2], box_2[:, 0] + box_2[:, 2])
+  top = np.minimum(np.minimum(box_1[:, 1] + box_1[:, 3], box_2[:, 1]), box_2[:, 3])
+  bot = np.maximum(box_1[:, 1], box_2[:, 1])
+
+  return get_region_maxes(dist_max, left, top, right, bot, vert_over <= 0)
+
+# Distance transform maximum in the region between boxes which are
+# beside each other (-1 if they overlap horizontally)
+def get_lr_dts(dist_max, box_1, box_2, horiz_over):
+  left = np.minimum(box_1[:, 0] + box_1[:, 2], box_2[:, 0] + box_2[:, 2])
+  right = np.maximum(box_1[:, 0], box_2[:, 0])
+  top = np.minimum(box_1[:, 1], box_2[:, 1])
+  bot = np.maximum(np.maximum(box_1[:, 1] + box_1[:, 3], box_2[:, 1]), box_2[:, 3])
+
+  return get_region_maxes(dist_max, left, top, right, bot, horiz_over <= 0)
+
+def get_region_maxes(dist_max, left, top, right, bot, mask):
+  values = np.full(len(mask), -1.0)
+
+  if mask.any():
+    values[mask] = dist_max.query_batch(left[mask], top[mask], right[mask], bot[mask])
+
+  return values
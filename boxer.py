@@ -1,23 +1,112 @@
+import box_features
 import clusterer
 import dir_helper
 import distance_transform
+import line_index
+import model_registry
+import numpy as np
 import os
 import operator
-import pickle
-from itertools import combinations
+import range_max
+import spatial_index
 from functools import cmp_to_key
 
 should_record_features = False
 
-def get_boxes(data, zoom_level, lines, contour_boxes, feature_file, img_base, image):
-  raw_boxes = get_boxes_from_json(data, zoom_level)
+classifier_path = 'classifier.pkl'
+
+# Number of jobs the classifier uses when scoring the pairs of an image
+classifier_n_jobs = 1
+
+# Use the probability of a merge as the score, rather than the 0/1 label
+use_classifier_probability = False
+
+# Boxes are merged if their score is above this
+merge_threshold = 0.99
+
+# Only boxes within this many pixels of each other are considered for
+# merging; any other pair is left unmerged. None considers every pair.
+merge_radius = 50
+
+# Padding around the OCR boxes when first computing the distance transform.
+# It grows from there if needed, so that the distances are exact.
+dt_region_padding = 20
 
-  dist_imgs = distance_transform.get_transform(img_base, image)
+# The smallest step of cv2's 3x3 L2 distance transform, so a distance d
+# can only come from an edge within d / dt_min_step pixels across or down
+dt_min_step = 0.955
 
-  combined = combine_boxes(raw_boxes, lines, contour_boxes, feature_file, dist_imgs)
+# Labelling cells from the OCR words: a word is in a cell if this much of
+# it (or of the cell, if smaller) overlaps the cell, and cells labelled
+# with at least local_label_confidence don't need to be read again
+local_label_threshold = 0.5
+local_label_confidence = 0.8
+
+# Ink this close to a cell's edge is ignored, as it's likely a border,
+# and ink this close to a word is taken to be part of it
+label_cell_inset = 2
+label_word_padding = 2
+
+def get_boxes(data, zoom_level, lines, contour_boxes, feature_file, ctx):
+  raw_boxes = get_boxes_from_json(data, zoom_level)
+
+  # Only combine_boxes holds the distance transform, so it can let it go
+  combined = combine_boxes(raw_boxes, lines, contour_boxes, feature_file, get_dist_max(raw_boxes, ctx))
 
   return combined, raw_boxes
 
+# Returns a range_max.RangeMax over the scaled distance transform, computed
+# only over the region the distance transform features can read
+def get_dist_max(boxes, ctx):
+  if len(boxes) < 2:
+    return None
+
+  shape = ctx.get_shape(zoomed=True)
+  img_area = shape[0] * shape[1]
+  whole = (0, 0, shape[1], shape[0])
+
+  inner = get_dt_region(boxes, shape, 0)
+  padding = dt_region_padding
+
+  # Cropping drops the edges outside the region, which can only make the
+  # distances larger. A distance in the boxes' region is still exact if
+  # its nearest edge is in the padding, so the padding grows until it
+  # covers the largest distance there, or the region is the whole image.
+  # (cv2 itself rounds slightly differently for different image sizes, so
+  # a distance can still be a float32 step off that of the whole image.)
+  while True:
+    region = get_dt_region(boxes, shape, padding)
+
+    # Only the scaled transform is used
+    dist_img = distance_transform.get_transform(ctx, keep_unscaled=False, region=region)[1]
+
+    if region == whole:
+      break
+
+    inner_dists = dist_img[inner[1] - region[1]:inner[3] - region[1], inner[0] - region[0]:inner[2] - region[0]]
+    needed = int(np.ceil(float(inner_dists.max()) * img_area / dt_min_step)) + 1
+
+    if needed <= padding:
+      break
+
+    padding = needed
+
+  return range_max.RangeMax(dist_img, origin=(region[0], region[1]))
+
+# The padded bounding box (left, top, right, bottom) of every rectangle the
+# distance transform features look at, in the coordinates they look it up
+# with (those of the boxes). This is the union of the boxes, except that
+# the top-to-bottom rectangles can reach up as far as the smallest height.
+def get_dt_region(boxes, shape, padding):
+  height, width = shape[:2]
+
+  left = min([box[0] for box in boxes]) - padding
+  top = min([min(box[1], box[3]) for box in boxes]) - padding
+  right = max([box[0] + box[2] for box in boxes]) + padding + 1
+  bottom = max([box[1] + box[3] for box in boxes]) + padding + 1
+
+  return (max(0, left), max(0, top), min(width, right), min(height, bottom))
+
 def get_boxes_from_json(data, zoom_level = 1):
   boxes = []
   if 'regions' in data:
@@ -37,13 +126,19 @@ def get_boxes_from_json(data, zoom_level = 1):
 
   return boxes
 
-def combine_boxes(boxes, lines, contour_boxes, feature_file, dist_imgs):
+def combine_boxes(boxes, lines, contour_boxes, feature_file, dist_max):
+  # Index the lines once, for all of the box pairs
+  line_indexes = line_index.get_line_indexes(lines)
+
   # To use the classifier, do this:
-  box_classifier_scores = score_boxes(boxes, lines, feature_file, dist_imgs)
+  idx_1, idx_2, box_classifier_scores = score_boxes(boxes, line_indexes, feature_file, dist_max)
 
-  box_scores = modify_box_scores(boxes, contour_boxes, box_classifier_scores)
+  # The distance transform is only needed for the features
+  dist_max = None
 
-  score_clusters = clusterer.cluster_scores(box_scores, 0.99)
+  box_scores = modify_box_scores(boxes, contour_boxes, idx_1, idx_2, box_classifier_scores)
+
+  score_clusters = clusterer.cluster_edges(len(boxes), idx_1, idx_2, box_scores, merge_threshold)
 
   # Now need to translate score_cluster indices into boxes,
   # And then combine the boxes in each cluster
@@ -55,8 +150,8 @@ def combine_boxes(boxes, lines, contour_boxes, feature_file, dist_imgs):
   return combined
 
 # This method lowers scores for boxes to prevent merging across
-# cell boundaries
-def modify_box_scores(boxes, c_boxes, scores):
+# cell boundaries. Scores are given per pair, for the pairs in idx_1, idx_2
+def modify_box_scores(boxes, c_boxes, idx_1, idx_2, scores):
   threshold = 0.5
   # First calculate the cells which each box overlaps
   # This should be only one, but we're using a set to be
@@ -73,22 +168,15 @@ def modify_box_scores(boxes, c_boxes, scores):
       if overlap_area * 1.0 / min_area > threshold:
         overlaps[i].add(j)
 
-  # Now, for each combination of boxes, we want
+  # Now, for each pair of boxes, we want
   # to penalize if they do not overlap a shared cell
   # (if their overlap sets are disjoint)
 
-  for comb in combinations(enumerate(boxes), 2):
-    i = comb[0][0]
-    j = comb[1][0]
-
-    box_1 = comb[0][1]
-    box_2 = comb[1][1]
-
+  for k, (i, j) in enumerate(zip(idx_1, idx_2)):
     if overlaps[i] != overlaps[j] and overlaps[i].isdisjoint(overlaps[j]):
       # This means they overlap different boxes
       # For now this will be an absolute penalty
-      scores[i][j] = 0.0
-      scores[j][i] = 0.0
+      scores[k] = 0.0
 
   return scores
 
@@ -118,163 +206,66 @@ def combine_clustered_boxes(clusters):
 
   return new_boxes
 
-def score_boxes(boxes, lines, feature_file, dist_imgs):
-  box_scores = [[0.0 for box in boxes] for box in boxes]
-
-  # Remove since we're appending for now
-  if should_record_features:
-    dir_helper.ensure(feature_file)
-
-    open(feature_file, 'w').close()
-
-  with open('classifier.pkl', 'rb') as f:
-    classifier = pickle.load(f)
-
-  features = {}
-
-  for comb in combinations(enumerate(boxes), 2):
-    i = comb[0][0]
-    j = comb[1][0]
-
-    box_1 = comb[0][1]
-    box_2 = comb[1][1]
-
-    scores = {}
-    features = {}
-
-    # 1. Higher score the closer together they are
-    # horiz and vert (percentage and flat)
-    horiz_dist = max(0, max(box_1[0], box_2[0]) - min(box_1[0] + box_1[2], box_2[0] + box_2[2]))
-    vert_dist = max(0, max(box_1[1], box_2[1]) - min(box_1[1] + box_1[3], box_2[1] + box_2[3]))
-
-    min_horiz_range = min(box_1[2], box_2[2])
-    min_vert_range = min(box_1[3], box_2[3])
-
-    dist = (horiz_dist ** 2 + vert_dist ** 2) ** 0.5
-    min_range = (min_horiz_range ** 2 + min_vert_range ** 2) ** 0.5
-
-    scores['dist_pix'] = 1.0 / (1.0 + dist)
-    scores['dist_perc'] = 1.0 / (1.0 + (dist * 1.0 / min_range))
-    features['dist_pix'] = dist
-    features['dist_perc'] = dist * 1.0 / min_range
-
-    # 2. Higher score if they overlap (horiz and vert)
-    # both percentage and flat
-    horiz_over = max(0, min(box_1[0] + box_1[2], box_2[0] + box_2[2]) - max(box_1[0], box_2[0]))
-    vert_over = max(0, min(box_1[1] + box_1[3], box_2[1] + box_2[3]) - max(box_1[1], box_2[1]))
-
-    scores['overlap_pix'] = 1.0 * horiz_over * vert_over
-    scores['overlap_perc'] = 1.0 * horiz_over * vert_over / (min_horiz_range * min_vert_range)
-    features['overlap_pix'] = horiz_over * vert_over
-    features['overlap_perc'] = scores['overlap_perc']
+# Returns the scored pairs as (idx_1, idx_2, scores), where pair k is
+# boxes idx_1[k] and idx_2[k]. Pairs that aren't listed are not merged.
+# Lines are given as the pair from line_index.get_line_indexes, and the
+# scaled distance transform as a range_max.RangeMax (see get_dist_max)
+def score_boxes(boxes, line_indexes, feature_file, dist_max):
+  classifier = get_classifier()
 
-    # Check for horizontal line b/w boxes
-    scores['no_div_horiz_line'] = 0.0 if line_between(box_1, box_2, lines, 1) else 1.0
-    features['no_div_horiz_line'] = 0 if line_between(box_1, box_2, lines, 1) else 1
+  idx_1, idx_2 = get_candidate_pairs(boxes)
 
-    # Check for vertical line b/w boxes
-    scores['no_div_vert_line'] = 0.0 if line_between(box_1, box_2, lines, 0) else 1.0
-    features['no_div_vert_line'] = 0 if line_between(box_1, box_2, lines, 0) else 1
+  # Compute the features for all of the pairs at once
+  features = box_features.get_feature_matrix(boxes, line_indexes, dist_max, idx_1, idx_2)
 
-    # Additional features?
-    # Ratio of areas
-    box_1_area = box_1[2] * box_1[3]
-    box_2_area = box_2[2] * box_2[3]
+  record_features(boxes, idx_1, idx_2, features, feature_file)
 
-    features['ratio_of_areas_1'] = box_1_area * 1.0 / box_2_area
-    features['ratio_of_areas_2'] = box_2_area * 1.0 / box_1_area
+  scores = get_classifier_scores(features, classifier)
 
-    # Area of box 1
-    features['box_1_area'] = box_1_area
+  return (idx_1, idx_2, scores)
 
-    # Area of box 2
-    features['box_2_area'] = box_2_area
+def get_candidate_pairs(boxes):
+  # Training data needs every combination, not just the nearby ones
+  if merge_radius is None or should_record_features:
+    return box_features.get_pair_indices(len(boxes))
 
-    # Left to right distance, and right to left distance
-    features['ltr_dist'] = min(abs(box_1[0] - (box_2[0] + box_2[2])), box_2[0] - (box_1[0] + box_1[2]))
+  return spatial_index.get_candidate_pairs(boxes, merge_radius)
 
-    # and top to bottom and bottom to top
-    features['ttb_dist'] = min(abs(box_1[1] - (box_2[1] + box_2[3])), box_2[1] - (box_1[1] + box_1[3]))
+# Loaded once per process, and reloaded if the file changes
+def get_classifier():
+  return model_registry.get_model(classifier_path)
 
-    # Line in between ignoring overlap
-    features['no_horiz_line_in_middle'] = 0 if line_in_middle(box_1, box_2, lines, 1) else 1
-    features['no_vert_line_in_middle'] = 0 if line_in_middle(box_1, box_2, lines, 0) else 1
-
-    # Distance between centers
-    features['dist_bw_vert_centers'] = abs((box_1[0] + box_1[0] + box_1[2]) - (box_2[0] + box_2[0] + box_2[2])) / 2.0
-    features['dist_bw_horiz_centers'] = abs((box_1[1] + box_1[1] + box_1[3]) - (box_2[1] + box_2[1] + box_2[3])) / 2.0
-
-    # Distance between tops
-    features['dist_bw_lefts'] = abs(box_1[0] - box_2[0])
-    features['dist_bw_tops'] = abs(box_1[1] - box_2[1])
-
-    # Distance between bottoms
-    features['dist_bw_rights'] = abs((box_1[0] + box_1[2]) - (box_2[0] + box_2[2]))
-    features['dist_bw_bottoms'] = abs((box_1[1] + box_1[3]) - (box_2[1] + box_2[3]))
-
-    # Distance transform features
-    features['dist_trans_tb_scaled'] = get_tb_dt(dist_imgs[1], box_1, box_2)
-    features['dist_trans_lr_scaled'] = get_lr_dt(dist_imgs[1], box_1, box_2)
-
-    score = get_classifier_score(features, classifier)
-    record_features(box_1, box_2, features, feature_file)
-
-    box_scores[i][j] = score
-    box_scores[j][i] = score
-
-  return box_scores
-
-def record_features(box_1, box_2, features, feature_file):
+# Features are stored in box_features.feature_names order
+def record_features(boxes, idx_1, idx_2, features, feature_file):
   if should_record_features:
-    with open(feature_file, 'a') as f:
-      f.write(','.join([str(x) for x in (box_1[0:4] + box_2[0:4])]))
-
-      for x in sorted(features.keys()):
-        f.write(',' + str(features[x]))
-
-      f.write('\n')
-
-def get_classifier_score(features, classifier):
-  features = [features[x] for x in sorted(features.keys())]
-
-  pred = classifier.predict([features])
-
-  return pred[0] * 1.0
-
-# Line in between without intersection
-def line_in_middle(box1, box2, lines, offset):
-  for line in lines[(offset + 1) % 2]:
-    # Should this be a comparison only b/w the innermost values?
+    dir_helper.ensure(feature_file)
 
-    # Check if box1, line, box2
-    is_bw_1 = box1[offset] + box1[offset + 2] <= line['border'] <= box2[offset]
+    with open(feature_file, 'w') as f:
+      for k, (i, j) in enumerate(zip(idx_1, idx_2)):
+        f.write(','.join([str(x) for x in (boxes[i][0:4] + boxes[j][0:4])]))
 
-    # Check if box2, line, box1
-    is_bw_2 = box2[offset] + box2[offset + 2] <= line['border'] <= box1[offset]
+        for x in features[k]:
+          f.write(',' + str(x))
 
-    if is_bw_1 or is_bw_2:
-      return True
-  return False
+        f.write('\n')
 
-def line_between(box1, box2, lines, offset):
-  for line in lines[(offset + 1) % 2]:
-    # Check if box1, line, box2
-    is_bw_1 = box1[offset] + box1[offset + 2] <= line['border'] <= box2[offset]
+# Scores all of the pairs in a single call to the classifier
+def get_classifier_scores(features, classifier):
+  if len(features) == 0:
+    return np.zeros(0)
 
-    # Check if box2, line, box1
-    is_bw_2 = box2[offset] + box2[offset + 2] <= line['border'] <= box1[offset]
+  if hasattr(classifier, 'n_jobs'):
+    classifier.n_jobs = classifier_n_jobs
 
-    alt_offset = (offset + 1) % 2
+  if use_classifier_probability:
+    classes = list(classifier.classes_)
 
-    # Check if the line overlaps with box1
-    intersects_1 = max(0, min(line['end'], box1[alt_offset] + box1[alt_offset + 2]) - max(line['start'], box1[alt_offset]))
+    if 1 not in classes:
+      return np.zeros(len(features))
 
-    # Check if the line overlaps with box2
-    intersects_2 = max(0, min(line['end'], box2[alt_offset] + box2[alt_offset + 2]) - max(line['start'], box2[alt_offset]))
-    if (is_bw_1 or is_bw_2) and (intersects_1 or intersects_2):
-      return True
+    return classifier.predict_proba(features)[:, classes.index(1)]
 
-  return False
+  return classifier.predict(features) * 1.0
 
 def combine_scores(scores):
   total = 0.0
@@ -304,6 +295,75 @@ def add_labels(boxes, label_boxes, threshold):
 
   return labeled
 
+# Labels the cells with the OCR words inside them, as add_labels does, with
+# the words joined into one label. Also returns how confident each label
+# is, from 0 to 1, as the lesser of:
+# - how clearly each word touching the cell is in or out of it, so a word
+#   split across the cell's edge makes the label doubtful
+# - the fraction of the ink in the cell (from the binarized image) that is
+#   covered by its words, so text the OCR missed makes the label doubtful
+# Cells with no words have a confidence of 0.
+def add_local_labels(boxes, label_boxes, ctx):
+  labeled = [(box[0], box[1], box[2], box[3], [' '.join(box[4])]) for box in add_labels(boxes, label_boxes, local_label_threshold)]
+
+  words = np.array([label_box[:4] for label_box in label_boxes], dtype=np.float64).reshape(-1, 4)
+  bin_img = ctx.get_binary()
+
+  confidences = [get_label_confidence(box, words, bin_img) for box in boxes]
+
+  return (labeled, confidences)
+
+def get_label_confidence(box, words, bin_img):
+  x, y, w, h = box[:4]
+
+  horiz_over = np.maximum(0, np.minimum(x + w, words[:, 0] + words[:, 2]) - np.maximum(x, words[:, 0]))
+  vert_over = np.maximum(0, np.minimum(y + h, words[:, 1] + words[:, 3]) - np.maximum(y, words[:, 1]))
+  overlap_area = horiz_over * vert_over
+  word_areas = words[:, 2] * words[:, 3]
+  min_areas = np.minimum(w * h, word_areas)
+
+  touching = overlap_area > 0
+  inside = touching & (overlap_area > local_label_threshold * min_areas)
+
+  if not inside.any():
+    return 0.0
+
+  # A word half in the cell is as doubtful as it gets
+  in_fraction = overlap_area[touching] / word_areas[touching]
+  word_confidence = np.min(np.maximum(in_fraction, 1 - in_fraction))
+
+  return min(float(word_confidence), get_ink_coverage(box, words[inside], bin_img))
+
+# Fraction of the dark pixels inside the cell that are covered by the words
+def get_ink_coverage(box, words, bin_img):
+  height, width = bin_img.shape[:2]
+
+  left = max(0, int(box[0]) + label_cell_inset)
+  top = max(0, int(box[1]) + label_cell_inset)
+  right = min(width, int(box[0] + box[2]) - label_cell_inset)
+  bottom = min(height, int(box[1] + box[3]) - label_cell_inset)
+
+  if right <= left or bottom <= top:
+    return 1.0
+
+  ink = bin_img[top:bottom, left:right] == 0
+  total = np.count_nonzero(ink)
+
+  if total == 0:
+    return 1.0
+
+  covered = np.zeros(ink.shape, dtype=bool)
+
+  for word in words:
+    word_left = max(0, int(word[0]) - label_word_padding - left)
+    word_top = max(0, int(word[1]) - label_word_padding - top)
+    word_right = max(0, int(word[0] + word[2]) + label_word_padding - left)
+    word_bottom = max(0, int(word[1] + word[3]) + label_word_padding - top)
+
+    covered[word_top:word_bottom, word_left:word_right] = True
+
+  return float(np.count_nonzero(ink & covered)) / total
+
 # Comparator for labels with some variance allowed for lines with variable toplines
 def label_comparator(a, b):
   top_dist = abs(a[1] - b[1])
@@ -494,31 +554,6 @@ def merge_ocr_boxes(raw_boxes, ai2_boxes, combo=False):
 
   return raw_boxes + merged
 
-def get_tb_dt(img, box_1, box_2):
-  if vert_overlap(box_1, box_2) > 0:
-    return -1
-
-  left = min(box_1[0], box_2[0])
-  right = max(box_1[0] + box_1[2], box_2[0] + box_2[2])
-  top = min(box_1[1] + box_1[3], box_2[1], box_2[3])
-  bot = max(box_1[1], box_2[1])
-
-  return max_val(img, left, top, right, bot)
-
-def get_lr_dt(img, box_1, box_2):
-  if horiz_overlap(box_1, box_2) > 0:
-    return -1
-
-  left = min(box_1[0] + box_1[2], box_2[0] + box_2[2])
-  right = max(box_1[0], box_2[0])
-  top = min(box_1[1], box_2[1])
-  bot = max(box_1[1] + box_1[3], box_2[1], box_2[3])
-
-  return max_val(img, left, top, right, bot)
-
-def max_val(img, left, top, right, bot):
-  return img[top:(bot+1), left:(right+1)].max()
-
 def horiz_overlap(box_1, box_2):
   return min(box_1[0] + box_1[2], box_2[0] + box_2[2]) - max(box_1[0], box_2[0])
 
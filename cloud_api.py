@@ -5,37 +5,158 @@ import cv2
 import base64
 import httplib2
 
-import dir_helper
+import mosaic
+import image_context
+import ocr_cache
+import ocr_replay
+import rate_limit
 
 from apiclient.discovery import build
+from apiclient.errors import HttpError
 from oauth2client.client import GoogleCredentials
 
+API_DISCOVERY_FILE = 'https://vision.googleapis.com/$discovery/rest?version=v1'
+
+# Limits on a single annotate call: images per request, and total size of
+# the encoded images (kept under the API's request size limit)
+max_batch_images = 16
+max_batch_bytes = 8 * 1024 * 1024
+
+# Retries on connection errors, 429s and server errors, before giving up
+max_retries = 5
+backoff_base = 1.0
+backoff_cap = 60.0
+
+# Pack all the cells of an image into a few mosaics, and read each
+# mosaic with one request, instead of reading each cell on its own
+use_mosaic = False
+
+# Built on first use, then shared by every request from this process
+service = None
+
+def get_service():
+  '''Build the vision service once, with application default credentials'''
+  global service
+
+  if service is None:
+    http = httplib2.Http()
+
+    credentials = GoogleCredentials.get_application_default().create_scoped(
+        ['https://www.googleapis.com/auth/cloud-platform'])
+    credentials.authorize(http)
+
+    service = build('vision', 'v1', http=http, discoveryServiceUrl=API_DISCOVERY_FILE)
+
+  return service
+
+def get_annotate_request(image_content):
+  return {
+    'image': {
+      'content': image_content
+     },
+    'features': [{
+      'type': 'TEXT_DETECTION',
+      'maxResults': 1
+     }]
+   }
+
+engine = 'google'
+mosaic_engine = 'google_mosaic'
+
+# Everything in a request other than the image, as part of the cache key
+feature_params = json.dumps(get_annotate_request('')['features'], sort_keys=True)
+
+annotate_path = '/v1/images:annotate'
+
+# Sends an annotate request, retrying with backoff if it fails in a way
+# that may not last, as a 429 or an injected replay fault does
+def annotate(body):
+  for attempt in range(max_retries + 1):
+    try:
+      return send_annotate(body)
+    except (HttpError, ocr_replay.ReplayError, OSError) as error:
+      status, retry_after = get_error_status(error)
+
+      if attempt == max_retries or not should_retry(status):
+        raise
+
+      time.sleep(get_retry_delay(attempt, retry_after))
+
+# Sends an annotate request, through the replay server in replay mode,
+# and saving the response in record mode
+def send_annotate(body):
+  if ocr_replay.mode == 'replay':
+    return ocr_replay.post_json(engine, annotate_path, body)
+
+  response = get_service().images().annotate(body=body).execute()
+
+  if ocr_replay.mode == 'record':
+    ocr_replay.record(engine, annotate_path, ocr_replay.encode_json(body), 200, json.dumps(response).encode('utf-8'))
+
+  return response
+
+# Returns (status, seconds from any Retry-After header) for a failed
+# request, with a status of None if no response came back
+def get_error_status(error):
+  if isinstance(error, HttpError):
+    return (int(error.resp.status), rate_limit.get_retry_after(error.resp.get('retry-after')))
+
+  if isinstance(error, ocr_replay.ReplayError):
+    return (error.status, error.retry_after)
+
+  return (None, None)
+
+def should_retry(status):
+  return status is None or status == 429 or status >= 500
+
+def get_retry_delay(attempt, retry_after):
+  delay = rate_limit.get_backoff_delay(attempt, backoff_base, backoff_cap)
+
+  if retry_after is not None:
+    return max(delay, retry_after)
+
+  return delay
+
 def query_google_ocr(image_content):
   '''Run a label request on a single image'''
 
-  API_DISCOVERY_FILE = 'https://vision.googleapis.com/$discovery/rest?version=v1'
-  http = httplib2.Http()
+  return annotate({
+    'requests': [get_annotate_request(image_content)]
+  })
+
+def query_google_ocr_batch(image_contents):
+  '''Run a label request on several images in one call. Returns one
+  response per image, in the same format as query_google_ocr, or None
+  for every image if the call returned no responses.'''
+
+  response = annotate({
+    'requests': [get_annotate_request(content) for content in image_contents]
+  })
+
+  if 'responses' not in response or len(response['responses']) != len(image_contents):
+    return [None] * len(image_contents)
+
+  return [{'responses': [single]} for single in response['responses']]
 
-  credentials = GoogleCredentials.get_application_default().create_scoped(
-      ['https://www.googleapis.com/auth/cloud-platform'])
-  credentials.authorize(http)
+# Splits the images into batches within the request limits
+def get_batches(image_contents):
+  batches = []
+  batch = []
+  batch_bytes = 0
 
-  service = build('vision', 'v1', http=http, discoveryServiceUrl=API_DISCOVERY_FILE)
+  for i, content in enumerate(image_contents):
+    if len(batch) > 0 and (len(batch) >= max_batch_images or batch_bytes + len(content) > max_batch_bytes):
+      batches.append(batch)
+      batch = []
+      batch_bytes = 0
 
-  service_request = service.images().annotate(
-    body={
-      'requests': [{
-        'image': {
-          'content': image_content
-         },
-        'features': [{
-          'type': 'TEXT_DETECTION',
-          'maxResults': 1
-         }]
-       }]
-    })
+    batch.append(i)
+    batch_bytes += len(content)
 
-  return service_request.execute()
+  if len(batch) > 0:
+    batches.append(batch)
+
+  return batches
 
 def get_labels(response, combine=False):
   if 'textAnnotations' not in response['responses'][0]:
@@ -62,42 +183,137 @@ def label_boxes(detections):
 
   return boxes
 
-def get_cell_label(cache_base, img_base, photo_file, box, zoom, sleep_delay):
-  cache_path = cache_base + photo_file + '_' + '_'.join([str(x) for x in box[:4]]) + '.json'
+# Older per-cell cache files, only read now, to copy them into the OCR cache
+def get_cache_path(cache_base, ctx, box):
+  return cache_base + ctx.image + '_' + '_'.join([str(x) for x in box[:4]]) + '.json'
 
-  if os.path.isfile(cache_path):
-    with open(cache_path, 'r') as cache_file:
-      response = json.loads(cache_file.read())
-  else:
-    img = cv2.imread(img_base + photo_file)
-    x1 = zoom * box[0]
-    x2 = x1 + (zoom * box[2])
-    y1 = zoom * box[1]
-    y2 = y1 + (zoom * box[3])
+def read_cache(cache_path):
+  if not os.path.isfile(cache_path):
+    return None
+
+  with open(cache_path, 'r') as cache_file:
+    return json.loads(cache_file.read())
+
+def get_cell_key(image_content):
+  return ocr_cache.get_key(engine, feature_params, image_content.encode('ascii'))
+
+# Returns the cached responses for the cells, by index, copying over any
+# that are only in the older cache files
+def get_cached_responses(cache, keys, cache_paths):
+  cached = cache.get_many(keys)
+  responses = {}
+  migrated = []
+
+  for i, key in enumerate(keys):
+    if key in cached:
+      responses[i] = cached[key]
+      continue
+
+    response = read_cache(cache_paths[i])
+
+    if response is not None:
+      responses[i] = response
+      migrated.append((key, engine, response))
 
-    cell = img[y1:y2, x1:x2]
+  if len(migrated) > 0:
+    cache.put_many(migrated)
 
-    retval, cell_buffer = cv2.imencode('.jpg', cell)
+  return responses
 
-    image_content = base64.b64encode(cell_buffer).decode()
+def encode_image(img):
+  retval, img_buffer = cv2.imencode('.jpg', img)
 
-    response = query_google_ocr(image_content)
+  return base64.b64encode(img_buffer).decode()
+
+# Base64 jpg of the box's region of the zoomed image
+def get_cell_content(ctx, box, zoom):
+  return encode_image(image_context.get_cell_crop(ctx, box, zoom))
+
+# Labels every box, sending the uncached cells in as few requests as the
+# limits allow. Cells are cached by their content, in the OCR cache at
+# db_path, and cache_path is where older cache files may still be.
+def add_labels(boxes, ctx, cache_path, zoom, sleep_delay, db_path):
+  if use_mosaic:
+    return add_labels_mosaic(boxes, ctx, zoom, sleep_delay, db_path)
+
+  cache = ocr_cache.get_cache(db_path)
+  contents = [get_cell_content(ctx, box, zoom) for box in boxes]
+  keys = [get_cell_key(content) for content in contents]
+
+  responses = get_cached_responses(cache, keys, [get_cache_path(cache_path, ctx, box) for box in boxes])
+  uncached = [i for i in range(len(boxes)) if i not in responses]
+
+  for batch in get_batches([contents[i] for i in uncached]):
+    batch_responses = query_google_ocr_batch([contents[uncached[i]] for i in batch])
+    fetched = []
 
     time.sleep(sleep_delay)
 
-    if 'responses' in response:
-      dir_helper.ensure(cache_path)
-      with open(cache_path, 'w') as cache_file:
-        json.dump(response, cache_file)
-    else:
-      return ''
+    for i, response in zip(batch, batch_responses):
+      box_idx = uncached[i]
+
+      # Failed cells are left uncached, so they're tried again next time
+      if response is not None and 'error' not in response['responses'][0]:
+        fetched.append((keys[box_idx], engine, response))
+        responses[box_idx] = response
 
-  return get_labels(response, combine=True)
+    cache.put_many(fetched)
 
-def add_labels(boxes, image_base, image_path, cache_path, zoom, sleep_delay):
   labeled = []
-  for box in boxes:
-    label = get_cell_label(cache_path, image_base, image_path, box, zoom, sleep_delay)
+  for i, box in enumerate(boxes):
+    label = get_labels(responses[i], combine=True) if i in responses else ''
     labeled.append((box[0], box[1], box[2], box[3], [label]))
 
   return labeled
+
+# Each mosaic is cached with its layout, so the response can be split
+# into cells again offline. The layout is part of the key, as it maps
+# the same pixels to different cells if the boxes are in another order.
+def get_mosaic_key(image_content, layout):
+  return ocr_cache.get_key(mosaic_engine, feature_params + json.dumps(layout, sort_keys=True), image_content.encode('ascii'))
+
+def add_labels_mosaic(boxes, ctx, zoom, sleep_delay, db_path):
+  cache = ocr_cache.get_cache(db_path)
+
+  crops = [image_context.get_cell_crop(ctx, box, zoom) for box in boxes]
+  layouts = mosaic.pack_cells([(crop.shape[1], crop.shape[0]) for crop in crops])
+  contents = [encode_image(mosaic.build_mosaic(crops, layout)) for layout in layouts]
+  keys = [get_mosaic_key(content, layout) for content, layout in zip(contents, layouts)]
+
+  cached = cache.get_many(keys)
+
+  entries = []
+
+  for content, layout, key in zip(contents, layouts, keys):
+    if key in cached:
+      entries.append(cached[key])
+      continue
+
+    response = query_google_ocr(content)
+
+    time.sleep(sleep_delay)
+
+    # Failed mosaics are left uncached, so they're tried again next time
+    if 'responses' not in response or 'error' in response['responses'][0]:
+      continue
+
+    entry = {'layout': layout, 'response': response}
+    cache.put(key, mosaic_engine, entry)
+    entries.append(entry)
+
+  labels = split_mosaic_labels(entries, len(boxes))
+
+  return [(box[0], box[1], box[2], box[3], [label]) for box, label in zip(boxes, labels)]
+
+# Splits the cached mosaic responses back into a label for each box
+def split_mosaic_labels(entries, num_boxes):
+  labels = [''] * num_boxes
+
+  for entry in entries:
+    # The first annotation is all of the text, and the rest are single words
+    words = entry['response']['responses'][0].get('textAnnotations', [])[1:]
+
+    for index, cell_words in mosaic.split_words(words, entry['layout']).items():
+      labels[index] = ' '.join(cell_words)
+
+  return labels
@@ -1,96 +1,184 @@
-import itertools
-from collections import deque
+import time
+import numpy as np
+
+# Limits on the maximal clique search used for rows and columns. Past
+# either one, the remaining items are covered greedily. None for no limit.
+clique_time_budget = 30.0
+clique_count_budget = 100000
 
 def cluster_scores(score_matrix, threshold):
-  clusters = []
-  for i in range(len(score_matrix)):
-    curr_cluster = set([i])
-    for j in range(len(score_matrix)):
-      curr_score = score_matrix[i][j]
-      if curr_score > threshold:
-        curr_cluster.add(j)
+  # Any pair scoring above the threshold is joined, in either direction
+  idx_1, idx_2 = np.nonzero(np.asarray(score_matrix).reshape(len(score_matrix), len(score_matrix)) > threshold)
 
-      clusters.append(curr_cluster)
+  return get_components(len(score_matrix), idx_1, idx_2)
+
+# Same as cluster_scores, but with the scores given only for the pairs
+# idx_1[k], idx_2[k], with any other pair treated as below the threshold
+def cluster_edges(num_items, idx_1, idx_2, scores, threshold):
+  above = np.asarray(scores) > threshold
+
+  return get_components(num_items, np.asarray(idx_1)[above], np.asarray(idx_2)[above])
+
+# Returns the connected components of the items joined by the given pairs,
+# as a list of sets ordered by their smallest member. This is a disjoint-set
+# forest, with path compression and union by rank.
+def get_components(num_items, idx_1, idx_2):
+  parents = list(range(num_items))
+  ranks = [0] * num_items
+
+  for i, j in zip(idx_1, idx_2):
+    union(parents, ranks, int(i), int(j))
 
-  # Now we need to merge any clusters with shared elements
-  # Based roughly on the algorithm from Niklas at:
-  # http://stackoverflow.com/questions/9110837/python-simple-list-merging-based-on-intersections
-  have_merged = True
-  while have_merged:
-    have_merged = False
-    new_clusters = []
-    while len(clusters) > 0:
-      first = clusters[0]
-      remaining = clusters[1:]
-      clusters = []
+  components = []
+  root_components = {}
 
-      for cluster in remaining:
-        if cluster.isdisjoint(first):
-          clusters.append(cluster)
-        else:
-          have_merged = True
-          first |= cluster
+  # Items are visited in order, so each component is added at its
+  # smallest member, and the list is ordered by smallest member
+  for i in range(num_items):
+    root = find(parents, i)
 
-      new_clusters.append(first)
+    if root not in root_components:
+      root_components[root] = len(components)
+      components.append(set())
 
-    clusters = new_clusters
+    components[root_components[root]].add(i)
 
-  return clusters
+  return components
 
+def find(parents, i):
+  root = i
+
+  while parents[root] != root:
+    root = parents[root]
+
+  # Point everything on the path directly at the root
+  while parents[i] != root:
+    parents[i], i = root, parents[i]
+
+  return root
+
+def union(parents, ranks, i, j):
+  root_i = find(parents, i)
+  root_j = find(parents, j)
+
+  if root_i == root_j:
+    return
+
+  if ranks[root_i] < ranks[root_j]:
+    root_i, root_j = root_j, root_i
+
+  parents[root_j] = root_i
+
+  if ranks[root_i] == ranks[root_j]:
+    ranks[root_i] += 1
+
+# Finds the maximal sets of items where every pair in the set scores at
+# least the threshold, i.e. the maximal cliques of the graph with an edge
+# between each such pair
 def newer_cluster_scores(score_matrix, threshold):
-  # Start with a set of all boxes
-  # Then, for any given pair in that set that's not likely to
-  # be in a (col|row) together, split the set. Continue
-  # this until we get a basis? Then need to reconcile
-  # the halves, and reduce, based on composition
-
-  # Make a set with all boxes
-  to_check = deque([frozenset(range(len(score_matrix)))])
-  finalized = set()
-  cache = set()
-
-  while len(to_check) > 0:
-    cluster = to_check.pop()
-    valid = True
-    for comb in itertools.combinations(cluster, 2):
-      # We want to split if there are any two elements
-      # that should not be in a row together
-      if score_matrix[comb[0]][comb[1]] < threshold:
-        valid = False
-
-        split_1 = cluster.difference([comb[0]])
-        split_2 = cluster.difference([comb[1]])
-
-        if split_1 not in cache:
-          to_check.append(split_1)
-          cache.add(split_1)
-
-        if split_2 not in cache:
-          to_check.append(split_2)
-          cache.add(split_2)
-
-        break
-
-    # If we made it to here, we checked all the combinations
-    # and they all belong in a column together
-    if valid and cluster not in finalized:
-      finalized.add(cluster)
-
-  # Check if any of the sets are proper subsets of another
-  # set in the final group. If so, we do not need the
-  # subset, as the info is elsewhere
-  basis = set()
-  for x in finalized:
-    keep = True
-    for y in finalized:
-      if x < y:
-        keep = False
-        break
-
-    if keep:
-      basis.add(x)
+  num_items = len(score_matrix)
+  compatible = np.asarray(score_matrix).reshape(num_items, num_items) >= threshold
+  compatible = compatible & compatible.T
 
-  return basis
+  idx_1, idx_2 = np.nonzero(np.triu(compatible, 1))
+
+  return newer_cluster_edges(num_items, idx_1, idx_2)
+
+# Same as newer_cluster_scores, but given only the compatible pairs,
+# idx_1[k] and idx_2[k]
+def newer_cluster_edges(num_items, idx_1, idx_2):
+  adjacency = [0] * num_items
+
+  for i, j in zip(idx_1, idx_2):
+    i = int(i)
+    j = int(j)
+
+    if i != j:
+      adjacency[i] |= 1 << j
+      adjacency[j] |= 1 << i
+
+  return get_maximal_cliques(num_items, adjacency)
+
+# Bron-Kerbosch with pivoting, with the vertex sets stored as bits of an int
+# (adjacency[i] has bit j set if i and j are connected). If it runs over the
+# time or clique count budget, any vertices not yet in a clique are covered
+# greedily instead, so a pathological image can't stall the whole batch.
+def get_maximal_cliques(num_items, adjacency):
+  cliques = set()
+  stack = [((), (1 << num_items) - 1, 0)]
+  start = time.time()
+  steps = 0
+
+  while len(stack) > 0:
+    steps += 1
+
+    if over_budget(start, steps, len(cliques)):
+      print('Clique search over budget, falling back to a greedy approximation')
+      return cliques | get_greedy_cliques(num_items, adjacency, cliques)
+
+    clique, candidates, excluded = stack.pop()
+
+    if candidates == 0:
+      if excluded == 0:
+        cliques.add(frozenset(clique))
+
+      continue
+
+    # Only branch on vertices that aren't neighbours of the pivot
+    pivot = max(get_bits(candidates | excluded), key=lambda u: count_bits(candidates & adjacency[u]))
+
+    for v in get_bits(candidates & ~adjacency[pivot]):
+      stack.append((clique + (v,), candidates & adjacency[v], excluded & adjacency[v]))
+
+      candidates &= ~(1 << v)
+      excluded |= 1 << v
+
+  return cliques
+
+def over_budget(start, steps, num_cliques):
+  if clique_count_budget is not None and num_cliques >= clique_count_budget:
+    return True
+
+  # Checking the clock on every step would be slow
+  if clique_time_budget is not None and steps % 256 == 0:
+    return time.time() - start > clique_time_budget
+
+  return False
+
+# Grows a maximal clique from each vertex not covered by the given cliques
+def get_greedy_cliques(num_items, adjacency, cliques):
+  covered = set().union(*cliques)
+  greedy = set()
+
+  for v in range(num_items):
+    if v in covered:
+      continue
+
+    clique = [v]
+    candidates = adjacency[v]
+
+    for u in get_bits(candidates):
+      if candidates & (1 << u):
+        clique.append(u)
+        candidates &= adjacency[u]
+
+    covered.update(clique)
+    greedy.add(frozenset(clique))
+
+  return greedy
+
+def get_bits(bits):
+  indices = []
+
+  while bits:
+    low = bits & -bits
+    indices.append(low.bit_length() - 1)
+    bits ^= low
+
+  return indices
+
+def count_bits(bits):
+  return bin(bits).count('1')
 
 def new_cluster_scores(score_matrix, threshold):
   clusters = []
@@ -3,5 +3,10 @@ import os
 def ensure(path):
   dname = os.path.dirname(path)
 
+  # A path with no directory is in the current one, which already exists
+  if dname == '':
+    return
+
+  # exist_ok, as parallel workers may create the same directory at once
   if not os.path.exists(dname):
-    os.makedirs(dname)
+    os.makedirs(dname, exist_ok=True)
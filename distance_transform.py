@@ -1,41 +1,57 @@
 import cv2
 import os
+import numpy as np
 
-def get_edge_image(base_path, img_name):
-  img = cv2.imread(base_path + '/' + img_name)
-  gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-  edges = cv2.Canny(gray, 50, 150, apertureSize = 3)
+from image_context import ImageContext
 
-  return edges
+# The transform is run on the zoomed image
+def get_edge_image(ctx):
+  return ctx.get_edges(zoomed=True)
 
 def process_image(base_path, img_name, out_path):
-  dist_img = get_transform(base_path, img_name)[1]
+  dist_img = get_transform(ImageContext(base_path, img_name), keep_unscaled=False)[1]
 
   cv2.imwrite(out_path + '/' + img_name, dist_img)
 
-def get_transform(base_path, img_name):
-  edges = get_edge_image(base_path, img_name)
+# Returns (distance transform, distance transform scaled by the image area),
+# both float32. An edge image can be passed in if it is already computed.
+# Without keep_unscaled, the first is None, and the scaling is done in place.
+# With a region (left, top, right, bottom), the transform only covers that
+# part of the image, but is still scaled by the area of the whole image.
+def get_transform(ctx, edges = None, keep_unscaled = True, region = None):
+  if edges is None:
+    edges = get_edge_image(ctx)
 #   cv2.imwrite(out_path + '/' + img_name + '_edges.jpg', edges)
 
-  inverted = get_inverted(edges)
+  img_area = edges.shape[0] * edges.shape[1]
+
+  if region is not None:
+    left, top, right, bottom = region
+    edges = edges[top:bottom, left:right]
+
+  # The edge image may be shared, so invert a copy of it
+  inverted = get_inverted(edges.copy())
 #   cv2.imwrite(out_path + '/' + img_name + '_inverted.jpg', inverted)
 
   dist_img = cv2.distanceTransform(inverted, cv2.DIST_L2, 3)
 
-  return (dist_img, scale_output(dist_img.copy()))
+  if not keep_unscaled:
+    return (None, scale_output(dist_img, img_area))
+
+  return (dist_img, scale_output(dist_img.copy(), img_area))
+
+# Scales in place, by the area of the image unless another area is given
+def scale_output(img, img_area = None):
+  if img_area is None:
+    img_area = img.shape[0] * img.shape[1]
 
-def scale_output(img):
-  img_area = len(img) * len(img[0])
-  for r in range(len(img)):
-    for c in range(len(img[r])):
-      img[r][c] = img[r][c] * 1.0 / img_area
+  np.divide(img, img_area, out=img)
 
   return img
 
+# Inverts an 8-bit image in place
 def get_inverted(img):
-  for r in range(len(img)):
-    for c in range(len(img[r])):
-      img[r][c] = 255 - img[r][c]
+  np.subtract(255, img, out=img)
 
   return img
 
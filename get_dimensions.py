@@ -1,83 +1,244 @@
 import os
 import sys
-import cv2
 import time
+import argparse
+import traceback
+import multiprocessing
 
 import score_rows
 import sub_key
-import oxford_api
 import boxer
 import liner
 import hallucinator
 import spreadsheeter
-import cloud_api
+import ocr_backends
+import oxford_api
+import image_pyramid
+from image_context import ImageContext
 
 zoom_level = 3
-oxford_delay = 5
 cloud_delay = 0
 
-def run_full_test(image_dir, info_dir):
+# Which OCR engine to read words and cells with (see ocr_backends.py)
+ocr_backend = 'oxford'
+
+# Fetch OCR for every image up front, with several requests in flight,
+# rather than one at a time as each image is processed
+prefetch_ocr = True
+
+# With batch output, every table goes into one workbook (a sheet for
+# each image) and one JSON Lines file, named this
+batch_output_name = 'tables'
+
+# Label cells from the words already found in the whole image, and only
+# read the cells that can't be labelled confidently again on their own
+use_local_labels = True
+
+def run_full_test(image_dir, info_dir, workers = 1, ocr = None, batch = False):
   images = [img for img in os.listdir(image_dir) if img.endswith('.jpg')]
-  run_test(images, image_dir, info_dir)
+  backend = get_ocr_backend(ocr if ocr is not None else ocr_backend)
 
+  if workers > 1:
+    run_parallel_test(images, image_dir, info_dir, workers, backend, batch)
+  else:
+    run_test(images, image_dir, info_dir, backend, batch)
 
-def run_test_image(image, img_dir, info_dir, zoom_prefix):
-    # Get OCR data from the oxford API
-    data = oxford_api.get_json_data(image, img_dir, zoom_level, info_dir, oxford_delay)
+def get_ocr_backend(name):
+  if name == 'oxford':
+    return ocr_backends.get_backend(name, cloud_delay=cloud_delay)
+
+  return ocr_backends.get_backend(name)
+
+
+def run_test_image(image, img_dir, info_dir, zoom_prefix, backend):
+    # Each resolution of the image is decoded once and shared by every stage
+    ctx = ImageContext(img_dir, image, zoom_level)
+
+    # Get the OCR words for the whole image
+    data = backend.get_json_data(image, img_dir, zoom_level, info_dir)
 
     # Extract lines from the image
-    lines = liner.get_lines(image, img_dir)
+    lines = liner.get_lines(ctx)
 
     # Extract hierarchical contours
-    h_boxes, hierarchy = hallucinator.get_contours(image, img_dir)
+    h_boxes, hierarchy = hallucinator.get_contours(ctx)
 
-    child_boxes, base_box = get_child_boxes(h_boxes, hierarchy, image, img_dir)
+    child_boxes, base_box = get_child_boxes(h_boxes, hierarchy, ctx)
 
-    ocr_boxes, raw_boxes = boxer.get_boxes(data, zoom_level, lines, child_boxes, info_dir + 'combos/features/' + image + '.txt', img_dir + '/' + zoom_prefix, image)
+    ocr_boxes, raw_boxes = boxer.get_boxes(data, zoom_level, lines, child_boxes, info_dir + 'combos/features/' + image + '.txt', ctx)
 
     merged_boxes = boxer.merge_box_groups(child_boxes, ocr_boxes, 0.9, base_box)
 
-    boxes = cloud_api.add_labels(merged_boxes, img_dir + '/' + zoom_prefix, image, info_dir + 'google_cache/' + zoom_prefix, zoom_level, cloud_delay)
+    boxes = label_boxes(merged_boxes, raw_boxes, ctx, info_dir, zoom_prefix, backend)
+
+    # Merge the line segments at the same offset into single grid lines
+    grid_lines = liner.get_sorted_avg_lines(lines)
 
-    scores = liner.rate_lines(lines, boxes)
+    scores = liner.rate_lines(grid_lines, boxes)
 
-    filtered_lines = liner.filter_lines(lines, boxes, scores);
+    filtered_lines = liner.filter_lines(grid_lines, boxes, scores);
 
-    new_lines = liner.remove_lines(lines, filtered_lines, scores)
+    new_lines = liner.remove_lines(grid_lines, filtered_lines, scores)
 
     rows, cols = score_rows.get_structure(boxes, new_lines)
 
     return (rows, cols, boxes)
 
-def run_test(images, img_dir, info_dir):
-  zoom_prefix = str(zoom_level) + 'x/' if zoom_level > 1 else ''
+def label_boxes(boxes, raw_boxes, ctx, info_dir, zoom_prefix, backend):
+  if use_local_labels:
+    labeled, confidences = boxer.add_local_labels(boxes, raw_boxes, ctx)
+    uncertain = [i for i, confidence in enumerate(confidences) if confidence < boxer.local_label_confidence]
+  else:
+    labeled = list(boxes)
+    uncertain = list(range(len(boxes)))
 
-  for image in images:
-    print('Processing: ' + image)
+  ocr_labeled = backend.add_labels([boxes[i] for i in uncertain], ctx, info_dir, zoom_prefix, zoom_level)
 
-    # Write to xlsx and json
-    rows, cols, boxes = run_test_image(image, img_dir, info_dir, zoom_prefix)
+  for i, box in zip(uncertain, ocr_labeled):
+    labeled[i] = box
 
+  return labeled
+
+def process_image(image, img_dir, info_dir, zoom_prefix, backend, batch_output = None):
+  rows, cols, boxes = run_test_image(image, img_dir, info_dir, zoom_prefix, backend)
+
+  # Write to xlsx and json, or add to the batch's
+  if batch_output is not None:
+    batch_output.add(image, rows, cols, boxes)
+  else:
     spreadsheeter.output(rows, cols, boxes, info_dir + 'xlsx' + '/' + zoom_prefix + image + '.xlsx', info_dir + 'json_out' + '/' + zoom_prefix + image + '.json')
 
-    print('Complete')
+def get_batch_output(info_dir, zoom_prefix):
+  return spreadsheeter.BatchOutput(info_dir + 'xlsx' + '/' + zoom_prefix + batch_output_name + '.xlsx', info_dir + 'json_out' + '/' + zoom_prefix + batch_output_name + '.jsonl')
+
+def get_zoom_prefix():
+  return str(zoom_level) + 'x/' if zoom_level > 1 else ''
+
+def run_test(images, img_dir, info_dir, backend, batch = False):
+  zoom_prefix = get_zoom_prefix()
+
+  if prefetch_ocr:
+    backend.prefetch(images, img_dir, zoom_level, info_dir)
+
+  batch_output = get_batch_output(info_dir, zoom_prefix) if batch else None
+
+  try:
+    for image in images:
+      print('Processing: ' + image)
+
+      process_image(image, img_dir, info_dir, zoom_prefix, backend, batch_output)
+
+      print('Complete')
+  finally:
+    if batch_output is not None:
+      batch_output.close()
+
+def init_worker(workers):
+  # Load the classifier once per worker, instead of once per image
+  boxer.get_classifier()
 
-def get_full_box(image, base_dir):
- height, width, channels = cv2.imread(base_dir + '/' + image).shape 
+  # Any OCR the prefetch missed is requested by the workers, each with
+  # its own copy of the rate limit, so each only gets its share
+  oxford_api.share_rate_limit(workers)
+
+def run_worker_image(task):
+  image, img_dir, info_dir, zoom_prefix, backend, batch = task
+
+  # Any failure is reported back rather than raised, so that
+  # one bad image doesn't take down the rest of the batch
+  try:
+    # In batch mode the table is sent back, to be written by the parent
+    if batch:
+      return (image, True, None, run_test_image(image, img_dir, info_dir, zoom_prefix, backend))
+
+    process_image(image, img_dir, info_dir, zoom_prefix, backend)
+  except Exception:
+    return (image, False, traceback.format_exc(), None)
+
+  return (image, True, None, None)
+
+def run_parallel_test(images, img_dir, info_dir, workers, backend, batch = False):
+  zoom_prefix = get_zoom_prefix()
+  tasks = [(image, img_dir, info_dir, zoom_prefix, backend, batch) for image in images]
+
+  successes = []
+  failures = []
+  start = time.time()
+
+  # Workers then read the OCR from the cache
+  if prefetch_ocr:
+    backend.prefetch(images, img_dir, zoom_level, info_dir)
+
+  # Levels decoded for the OCR would otherwise be copied into every worker
+  image_pyramid.clear()
+
+  pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(workers,))
+  batch_output = None
+
+  try:
+    # Tables are added in the order they finish
+    batch_output = get_batch_output(info_dir, zoom_prefix) if batch else None
+
+    for image, succeeded, error, table in pool.imap_unordered(run_worker_image, tasks):
+      if succeeded:
+        if table is not None:
+          batch_output.add(image, *table)
+
+        print('Complete: ' + image)
+        successes.append(image)
+      else:
+        print('Failed: ' + image + '\n' + error)
+        failures.append(image)
+
+    pool.close()
+  except BaseException:
+    # Whatever stopped the loop (an interrupt, or a failure writing the
+    # output), the workers are stopped too, so join doesn't wait on them
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+    if batch_output is not None:
+      batch_output.close()
+
+  print_summary(successes, failures, time.time() - start)
+
+  return (successes, failures)
+
+def print_summary(successes, failures, elapsed):
+  print('Processed ' + str(len(successes) + len(failures)) + ' images in ' + '{0:.1f}'.format(elapsed) + 's')
+  print('Succeeded: ' + str(len(successes)))
+  print('Failed: ' + str(len(failures)))
+
+  for image in sorted(failures):
+    print('  ' + image)
+
+def get_full_box(ctx):
+ height, width, channels = ctx.get_shape()
 
  return (0, 0, width, height, '')
 
-def get_child_boxes(h_boxes, hierarchy, image, base_dir):
+def get_child_boxes(h_boxes, hierarchy, ctx):
   best_rects = h_boxes
-  base_box = get_full_box(image, base_dir)
+  base_box = get_full_box(ctx)
 
   return (hallucinator.contours_to_boxes(hallucinator.get_child_contours(best_rects, hierarchy)), base_box)
 
+def parse_args(argv):
+  parser = argparse.ArgumentParser(prog=argv[0])
+  parser.add_argument('src_dir')
+  parser.add_argument('out_dir')
+  parser.add_argument('--workers', type=int, default=1, help='number of worker processes (default: 1, serial)')
+  parser.add_argument('--batch', action='store_true', help='write every table to one workbook and one JSON Lines file')
+  parser.add_argument('--ocr', choices=sorted(ocr_backends.backends), default=ocr_backend, help='OCR engine (default: ' + ocr_backend + ')')
+
+  return parser.parse_args(argv[1:])
+
 if __name__ == '__main__':
-  if len(sys.argv) != 3:
-    exit('Usage: ' + sys.argv[0] + ' src_dir out_dir')
+  args = parse_args(sys.argv)
 
-  image_dir = sys.argv[1].rstrip('/')
-  info_dir = sys.argv[2].rstrip('/') + '/'
+  image_dir = args.src_dir.rstrip('/')
+  info_dir = args.out_dir.rstrip('/') + '/'
 
-  run_full_test(image_dir, info_dir)
+  run_full_test(image_dir, info_dir, args.workers, args.ocr, args.batch)
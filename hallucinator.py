@@ -2,32 +2,42 @@ import numpy as np
 import cv2
 from itertools import combinations
 
-def get_contours(img_name, base_path):
-  img = cv2.imread(base_path + '/' + img_name)
-  gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-  bin_img = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY)[1]
+def get_contours(ctx):
+  # findContours may modify its input, and the binary image is shared
+  bin_img = ctx.get_binary().copy()
 
   (edges, contours, hierarchy) = cv2.findContours(bin_img, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
 
-  rects = []
-  approxes = []
+  min_area = 200
+  quads = []
 
   for i,contour in enumerate(contours):
+    # Quick rejection first: the approximation uses a subset of the contour's
+    # points, so it needs at least four of them, and can't cover more area
+    # than the bounding box, which is one pixel smaller than boundingRect's
+    if len(contour) < 4:
+      continue
+
+    x, y, width, height = cv2.boundingRect(contour)
+
+    if (width - 1) * (height - 1) <= min_area:
+      continue
+
     perim = cv2.arcLength(contour, True)
     approx = cv2.approxPolyDP(contour, perim * 0.02, True)
-    approxes.append(approx)
 
     # If approximated with a quadrilateral, we want to save
     # and cv2.contourArea(cnt) > 1000 and cv2.isContourConvex(cnt)
     # Going to need to check if it detects rectangles with multiple cells, and cut those elsewhere
     # and use them for table label info like title, etc.
 
-    if len(approx) == 4 and cv2.isContourConvex(approx) and cv2.contourArea(approx) > 200:
-      temp_contour = approx.reshape(-1, 2)
-      max_cos = np.max([angle_cos(temp_contour[i], temp_contour[(i+1) % 4], temp_contour[(i+2) % 4]) for i in range(4)])
+    if len(approx) == 4 and cv2.isContourConvex(approx) and cv2.contourArea(approx) > min_area:
+      quads.append((i, approx))
 
-      if max_cos < 0.1:
-        rects.append((i,approx)) # Keep the index and the contour
+  # Keep the quadrilaterals with all corners close to right angles
+  max_cos = get_max_corner_cos(np.array([approx.reshape(4, 2) for (i, approx) in quads]).reshape(-1, 4, 2))
+
+  rects = [quad for quad, cos in zip(quads, max_cos) if cos < 0.1] # Keep the index and the contour
 
   return (rects, hierarchy)
 
@@ -47,61 +57,91 @@ def get_most_nested(contours, hierarchy, rects):
   if len(contours) < 1:
     return None
 
+  # Number of the rects below each contour, for all contours at once
+  counts = get_descendant_counts(hierarchy, [x[0] for x in rects])
+
   max_total = 0
   max_contour = contours[0]
-  max_children = []
 
   for contour in contours:
-    children = get_all_children(contour[0], hierarchy, rects)
-    total_children = len(children)
-    
-    if total_children > max_total:
-      max_total = total_children
+    if counts[contour[0]] > max_total:
+      max_total = counts[contour[0]]
       max_contour = contour
-      max_children = children
+
+  max_children = get_all_children(max_contour[0], hierarchy, rects) if max_total > 0 else []
 
   return (max_contour, max_children)
 
 def get_child_contours(rects, hierarchy):
-  idxes = [i for (i, c) in rects]
+  if len(rects) == 0:
+    return []
+
+  counts = get_descendant_counts(hierarchy, [i for (i, c) in rects])
 
   # Select the contours in this group that are child contours
+  # (with none of the others below them)
   # These should be cell-level contours, hopefully
-  return [contour for (idx, contour) in rects if no_children(idxes, hierarchy, idx)]
+  return [contour for (idx, contour) in rects if counts[idx] == 0]
 
 def get_all_children(idx, hierarchy, rects):
-  children = []
-  new_children = get_children(hierarchy, idx)
+  child_lists = get_child_lists(hierarchy)
+
+  children = set()
+  new_children = list(child_lists[idx])
 
   while len(new_children) > 0:
-    children += new_children
-    grandchildren = []
+    curr_idx = new_children.pop()
+    children.add(curr_idx)
+    new_children += child_lists[curr_idx]
 
-    for i in new_children:
-      grandchildren += get_children(hierarchy, i)
+  return [x[0] for x in rects if x[0] in children]
 
-    new_children = grandchildren
+# The children of every contour (in index order), from the parent
+# column of the hierarchy, built in one pass
+def get_child_lists(hierarchy):
+  parents = np.asarray(hierarchy[0])[:, 3]
 
-  return [x[0] for x in rects if x[0] in children]
+  # A stable sort keeps each contour's children in index order
+  order = np.argsort(parents, kind='mergesort')
+  sorted_parents = parents[order]
+
+  starts = np.searchsorted(sorted_parents, np.arange(len(parents)), side='left')
+  ends = np.searchsorted(sorted_parents, np.arange(len(parents)), side='right')
+
+  return [order[start:end].tolist() for start, end in zip(starts, ends)]
+
+# Returns the contours ordered so that every contour comes after all of its
+# descendants
+def get_post_order(hierarchy, child_lists):
+  parents = np.asarray(hierarchy[0])[:, 3]
+  to_visit = np.flatnonzero(parents == -1).tolist()
+  visited = []
+
+  while len(to_visit) > 0:
+    idx = to_visit.pop()
+    visited.append(idx)
+    to_visit += child_lists[idx]
 
-def no_children(idxes, hierarchy, idx):
-  children = get_children(hierarchy, idx)
+  # Every contour is visited after its parent, so reverse that
+  visited.reverse()
 
-  while len(children) > 0:
-    curr_idx = children.pop()
+  return visited
 
-    # If the current child is in the list
-    # Then we can shortcut and exit
-    if curr_idx in idxes:
-      return False
+# For every contour, the number of its descendants which are in idxes
+def get_descendant_counts(hierarchy, idxes):
+  child_lists = get_child_lists(hierarchy)
 
-    # Get any children of the current child
-    children += get_children(hierarchy, curr_idx)
+  marked = [False] * len(child_lists)
+  for idx in idxes:
+    marked[idx] = True
 
-  return True
+  counts = [0] * len(child_lists)
 
-def get_children(hierarchy, idx):
-  return [i for i,x in enumerate(hierarchy[0]) if x[3] == idx]
+  for idx in get_post_order(hierarchy, child_lists):
+    for child in child_lists[idx]:
+      counts[idx] += counts[child] + (1 if marked[child] else 0)
+
+  return counts
 
 def get_root_contours(rects, hierarchy):
 
@@ -136,22 +176,27 @@ def get_largest_contour(contours):
 
   return max_contour
 
-def angle_cos(p0, p1, p2):
-  d1, d2 = (p0-p1).astype('float'), (p2-p1).astype('float')
-  return abs(np.dot(d1, d2) / np.sqrt(np.dot(d1, d1)*np.dot(d2, d2)))
+# The largest absolute cosine of the angle at any corner of each quad,
+# over (quads x 4 x 2) corner points
+def get_max_corner_cos(points):
+  if len(points) == 0:
+    return np.zeros(0)
 
-def contour_to_box(contour):
-  max_x = max_y = float('-inf')
-  min_x = min_y = float('inf')
+  points = points.astype('float')
+  d1 = points - np.roll(points, -1, axis=1)
+  d2 = np.roll(points, -2, axis=1) - np.roll(points, -1, axis=1)
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    cos = np.abs((d1 * d2).sum(axis=2) / np.sqrt((d1 * d1).sum(axis=2) * (d2 * d2).sum(axis=2)))
 
-  for point in contour:
-    max_x = max(max_x, point[0][0])
-    max_y = max(max_y, point[0][1])
-    min_x = min(min_x, point[0][0])
-    min_y = min(min_y, point[0][1])
+  return cos.max(axis=1)
+
+def contour_to_box(contour):
+  x, y, width, height = cv2.boundingRect(contour)
 
   # Storing as x, y, width, height)
-  return (min_x, min_y, max_x - min_x, max_y - min_y, '')
+  # boundingRect counts pixels, so is one bigger than the distance between edges
+  return (x, y, width - 1, height - 1, '')
 def contours_to_boxes(contours):
   boxes = []
   for contour in contours:
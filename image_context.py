@@ -0,0 +1,53 @@
+import cv2
+
+import image_pyramid
+
+# Holds the decoded image for a single pipeline run, so each file is only
+# read from disk once, along with the grayscale, edge and binarized
+# versions that several stages share. Anything returned from here is
+# shared, so callers should copy before modifying it.
+class ImageContext:
+  def __init__(self, img_dir, image, zoom_level = 1):
+    self.img_dir = img_dir
+    self.image = image
+    self.zoom_level = zoom_level
+    self.cache = {}
+
+  def get_zoom(self, zoomed = False):
+    return self.zoom_level if zoomed else 1
+
+  # The zoomed image is made from the base image if there's no file for it
+  def get_image(self, zoomed = False):
+    return self.get_cached('image', zoomed, lambda: image_pyramid.get_level(self.img_dir, self.image, self.get_zoom(zoomed)))
+
+  def get_gray(self, zoomed = False):
+    return self.get_cached('gray', zoomed, lambda: cv2.cvtColor(self.get_image(zoomed), cv2.COLOR_BGR2GRAY))
+
+  def get_edges(self, zoomed = False):
+    return self.get_cached('edges', zoomed, lambda: cv2.Canny(self.get_gray(zoomed), 50, 150, apertureSize = 3))
+
+  def get_binary(self, zoomed = False):
+    return self.get_cached('binary', zoomed, lambda: cv2.threshold(self.get_gray(zoomed), 200, 255, cv2.THRESH_BINARY)[1])
+
+  def get_shape(self, zoomed = False):
+    return self.get_image(zoomed).shape
+
+  def get_cached(self, kind, zoomed, create):
+    # Keyed on the zoom, so that with a zoom of 1 the base
+    # and zoomed images share the same entries
+    key = (kind, self.get_zoom(zoomed))
+
+    if key not in self.cache:
+      self.cache[key] = create()
+
+    return self.cache[key]
+
+# The box's region of the zoomed image
+def get_cell_crop(ctx, box, zoom):
+  img = ctx.get_image(zoomed=True)
+  x1 = zoom * box[0]
+  x2 = x1 + (zoom * box[2])
+  y1 = zoom * box[1]
+  y2 = y1 + (zoom * box[3])
+
+  return img[y1:y2, x1:x2]
@@ -0,0 +1,124 @@
+import os
+import hashlib
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+# Zoomed versions of the images, made from the base image when first
+# needed, rather than read from a pre-scaled copy in img_dir/<zoom>x/
+# (which is still used if it exists). Decoded levels are kept in memory,
+# least recently used first out once they take up more than max_bytes.
+# With spill_dir set, levels pushed out are written there as raw arrays,
+# and memory-mapped back in when needed again, rather than remade.
+
+max_bytes = 1024 * 1024 * 1024
+spill_dir = None
+
+# Used when scaling up the base image
+interpolation = cv2.INTER_CUBIC
+
+# (image path, zoom) to its decoded level
+levels = OrderedDict()
+level_bytes = 0
+
+# (image path, zoom) to the (path, shape, dtype) of its spilled copy
+spilled = {}
+
+def get_level(img_dir, image, zoom = 1):
+  global level_bytes
+
+  key = (get_path(img_dir, image, 1), zoom)
+
+  if key in levels:
+    levels.move_to_end(key)
+    return levels[key]
+
+  if key in spilled:
+    path, shape, dtype = spilled[key]
+    img = np.memmap(path, dtype=dtype, mode='r', shape=shape)
+  else:
+    img = load_level(img_dir, image, zoom)
+
+  levels[key] = img
+  level_bytes += img.nbytes
+
+  evict(key)
+
+  return img
+
+# Encoded image data for the level, as sent for OCR: the file itself if
+# there is one, or else the level encoded as a jpg
+def get_encoded(img_dir, image, zoom = 1):
+  path = get_path(img_dir, image, zoom)
+
+  if os.path.isfile(path):
+    with open(path, 'rb') as img_file:
+      return img_file.read()
+
+  retval, img_buffer = cv2.imencode('.jpg', get_level(img_dir, image, zoom))
+
+  return img_buffer.tobytes()
+
+def get_path(img_dir, image, zoom = 1):
+  prefix = str(zoom) + 'x/' if zoom > 1 else ''
+
+  return img_dir + '/' + prefix + image
+
+def load_level(img_dir, image, zoom):
+  path = get_path(img_dir, image, zoom)
+
+  if zoom == 1 or os.path.isfile(path):
+    return read_image(path)
+
+  return cv2.resize(get_level(img_dir, image, 1), None, fx=zoom, fy=zoom, interpolation=interpolation)
+
+# Drops least recently used levels until under max_bytes, other than the
+# one just added
+def evict(keep):
+  global level_bytes
+
+  while level_bytes > max_bytes and len(levels) > 1:
+    key, img = next(iter(levels.items()))
+
+    if key == keep:
+      levels.move_to_end(key)
+      continue
+
+    del levels[key]
+    level_bytes -= img.nbytes
+
+    if spill_dir is not None and key not in spilled:
+      spill(key, img)
+
+def spill(key, img):
+  path = os.path.join(spill_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.raw')
+
+  os.makedirs(spill_dir, exist_ok=True)
+
+  buffer = np.memmap(path, dtype=img.dtype, mode='w+', shape=img.shape)
+  buffer[:] = img
+  buffer.flush()
+  del buffer
+
+  spilled[key] = (path, img.shape, img.dtype)
+
+def clear():
+  global level_bytes
+
+  levels.clear()
+  level_bytes = 0
+
+  for path, shape, dtype in spilled.values():
+    if os.path.exists(path):
+      os.remove(path)
+
+  spilled.clear()
+
+def read_image(path):
+  img = cv2.imread(path)
+
+  if img is None:
+    raise IOError('Unable to read image: ' + path)
+
+  return img
@@ -0,0 +1,132 @@
+import numpy as np
+
+# Index over the lines of one axis (all horizontal or all vertical), built
+# once per image. Lines are sorted by border, so the lines between two
+# offsets are a contiguous range, covered by O(log L) nodes of a segment
+# tree over that range. Each node keeps its lines' starts in sorted order,
+# with a running maximum of their ends, so whether any line of a node
+# overlaps a span is one binary search. Whether any line in a border range
+# overlaps a span is then O(log^2 L), rather than a scan of every line.
+#
+# The nodes are stored flat, in one array sorted by (node, start): each
+# start is stored as node * width + (start - min start), with width larger
+# than the range of starts, so one searchsorted finds a value within any
+# node, for many queries at once.
+class LineIndex:
+  def __init__(self, lines):
+    lines = sorted(lines, key = lambda info: info['border'])
+
+    self.borders = np.array([line['border'] for line in lines], dtype=np.float64)
+    self.starts = np.array([line['start'] for line in lines], dtype=np.float64)
+    self.ends = np.array([line['end'] for line in lines], dtype=np.float64)
+
+    self.size = 1
+    while self.size < len(lines):
+      self.size *= 2
+
+    # A line that ends before it starts can't overlap anything
+    kept = np.flatnonzero(self.ends > self.starts)
+
+    self.min_start = self.starts[kept].min() if len(kept) > 0 else 0.0
+    self.width = (self.starts[kept].max() - self.min_start + 2.0) if len(kept) > 0 else 2.0
+
+    # Each kept line is in one node per level, from its leaf up to the root
+    levels = self.size.bit_length()
+    nodes = np.concatenate([(kept + self.size) >> level for level in range(levels)])
+    line_idxs = np.tile(kept, levels)
+
+    order = np.lexsort((self.starts[line_idxs], nodes))
+    nodes = nodes[order]
+    line_idxs = line_idxs[order]
+
+    self.node_keys = nodes * self.width + (self.starts[line_idxs] - self.min_start)
+
+    # Running maximum of the ends within each node. Ends are shifted by
+    # the node, so that every node's values are above the previous one's.
+    if len(line_idxs) > 0:
+      ends = self.ends[line_idxs]
+      end_width = ends.max() - ends.min() + 1.0
+      shifted = (ends - ends.min()) + nodes * end_width
+      self.node_max_ends = np.maximum.accumulate(shifted) - nodes * end_width + ends.min()
+    else:
+      self.node_max_ends = np.zeros(0, dtype=np.float64)
+
+  def __len__(self):
+    return len(self.borders)
+
+  # Whether any line has a border in [low, high]
+  def any_between(self, low, high):
+    return self.count_between(low, high) > 0
+
+  def count_between(self, low, high):
+    return int(np.searchsorted(self.borders, high, side='right') - np.searchsorted(self.borders, low, side='left'))
+
+  # Whether any line with a border in [low, high] overlaps the span
+  # [span_start, span_end] by more than a point
+  def any_overlapping_between(self, low, high, span_start, span_end):
+    return bool(self.any_overlapping_between_batch(np.array([low]), np.array([high]), np.array([span_start]), np.array([span_end]))[0])
+
+  # Vectorized any_between, over arrays of low and high
+  def any_between_batch(self, low, high):
+    return np.searchsorted(self.borders, high, side='right') - np.searchsorted(self.borders, low, side='left') > 0
+
+  # Vectorized any_overlapping_between, over arrays of equal length. All
+  # of the queries walk up the tree together, a level at a time, checking
+  # the nodes that cover their border range.
+  def any_overlapping_between_batch(self, low, high, span_start, span_end):
+    span_start = np.asarray(span_start, dtype=np.float64)
+    span_end = np.asarray(span_end, dtype=np.float64)
+
+    found = np.zeros(len(span_start), dtype=bool)
+
+    if len(self.node_keys) == 0:
+      return found
+
+    first = np.searchsorted(self.borders, low, side='left') + self.size
+    last = np.searchsorted(self.borders, high, side='right') + self.size
+
+    # Only non-empty spans can be overlapped
+    active = np.flatnonzero((first < last) & (span_end > span_start))
+    first = first[active]
+    last = last[active]
+
+    while len(active) > 0:
+      check_first = first % 2 == 1
+      found[active[check_first]] |= self.nodes_overlap(first[check_first], span_start[active[check_first]], span_end[active[check_first]])
+      first = first + check_first
+
+      check_last = (last % 2 == 1) & (first < last)
+      last = last - check_last
+      found[active[check_last]] |= self.nodes_overlap(last[check_last], span_start[active[check_last]], span_end[active[check_last]])
+
+      first //= 2
+      last //= 2
+
+      # Queries that found a line, or have no range left, are done
+      remaining = (first < last) & ~found[active]
+      active = active[remaining]
+      first = first[remaining]
+      last = last[remaining]
+
+    return found
+
+  # For each node, whether any of its lines starts before the span ends,
+  # and ends after it starts
+  def nodes_overlap(self, nodes, span_start, span_end):
+    base = nodes * self.width
+
+    # Clipped into the node's range of keys, above every start if the span
+    # ends after all of them, and below every start if before all of them
+    offset = np.clip(span_end - self.min_start, -0.5, self.width - 1.0)
+
+    lower = np.searchsorted(self.node_keys, base - 0.5, side='left')
+    upper = np.searchsorted(self.node_keys, base + offset, side='left')
+
+    overlaps = upper > lower
+    overlaps[overlaps] = self.node_max_ends[upper[overlaps] - 1] > span_start[overlaps]
+
+    return overlaps
+
+# Returns the (horizontal, vertical) indexes for a (horizontal, vertical) pair of line lists
+def get_line_indexes(lines):
+  return (LineIndex(lines[0]), LineIndex(lines[1]))
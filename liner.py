@@ -1,13 +1,12 @@
 import numpy as np
 import cv2
-from itertools import combinations
+from bisect import bisect_left, bisect_right
+from collections import deque
 
 verbose = False
 
-def get_lines(img_name, base_path):
-  img = cv2.imread(base_path + '/' + img_name)
-  gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-  edges = cv2.Canny(gray, 50, 150, apertureSize = 3)
+def get_lines(ctx):
+  edges = ctx.get_edges()
   # cv2.imwrite('regents/canny/' + img_name, edges)
   # 120, 20, 10 is good. Also 80, 20, 1
   lines = cv2.HoughLinesP(edges, 1, np.pi / 180, 120, minLineLength=40, maxLineGap=2)
@@ -45,27 +44,23 @@ def get_lines(img_name, base_path):
 
   return (horiz_lines, vert_lines)
   
+# Merges the line segments at (nearly) the same offset into single lines,
+# returning them sorted by border
 def get_sorted_avg_lines(lines):
   horiz_lines = lines[0]
   vert_lines = lines[1]
 
   # Now bin the lines
   tolerance = 6
-  horiz_bins = []
-  vert_bins = []
-  
-  for line in horiz_lines:
-    bin_value(line, horiz_bins, tolerance)
-  
-  for line in vert_lines:
-    bin_value(line, vert_bins, tolerance)
-  
+  horiz_bins = bin_lines(horiz_lines, tolerance)
+  vert_bins = bin_lines(vert_lines, tolerance)
+
+  display_bins(horiz_bins)
+  display_bins(vert_bins)
+
   # Now average out the bins
   horiz_markers = average_bins(horiz_bins)
-  horiz_markers.sort()
-  
   vert_markers = average_bins(vert_bins)
-  vert_markers.sort()
 
   return (horiz_markers, vert_markers)
 
@@ -105,33 +100,86 @@ def filter_lines(lines, boxes, scores):
 
   return (horiz_removed_lines, vert_removed_lines)
 
+# Removes the lower scoring of any two lines (at different offsets) that have
+# no box edge between them. A line is removed if any such partner outscores
+# it, with ties going to the later line. Partners of a line are exactly the
+# lines between the nearest box edges on either side of it, so this is one
+# sweep over the lines sorted by border, with sliding window maxima.
 def check_lines(lines, boxes, scores, offset):
+  edges = get_box_edges(boxes, offset)
+
+  # Group the lines at the same offset, which are never compared
+  borders = []
+  groups = []
+
+  for i in sorted(range(len(lines)), key = lambda i: lines[i]['border']):
+    if len(borders) > 0 and lines[i]['border'] == borders[-1]:
+      groups[-1].append(i)
+    else:
+      borders.append(lines[i]['border'])
+      groups.append([i])
+
+  best = [max([(scores[i], i) for i in group]) for group in groups]
+
+  # The range of groups with no box edge between them and each group
+  left_windows = []
+  right_windows = []
+
+  for g, border in enumerate(borders):
+    prev_edge = bisect_left(edges, border)
+    next_edge = bisect_right(edges, border)
+
+    first = 0 if prev_edge == 0 else bisect_left(borders, edges[prev_edge - 1])
+    last = len(borders) - 1 if next_edge == len(edges) else bisect_right(borders, edges[next_edge]) - 1
+
+    left_windows.append((first, g - 1))
+    right_windows.append((g + 1, last))
+
+  left_best = get_window_maxes(best, left_windows)
+  right_best = get_window_maxes(best, right_windows)
+
   removed_lines = set()
-  for comb in combinations(enumerate(lines), 2):
-    line_1 = comb[0][1]
-    line_2 = comb[1][1]
-    min_val = min(line_1['border'], line_2['border'])
-    max_val = max(line_1['border'], line_2['border'])
-
-    box_inbetween = False
-    for box in boxes:
-      box_edge_1 = box[offset]
-      box_edge_2 = box[offset] + box[offset + 2]
-      if (box_edge_1 < max_val and box_edge_1 > min_val) or (box_edge_2 < max_val and box_edge_2 > min_val):
-        box_inbetween = True
-
-    # Quick hack for now to avoid cutting two line segments at the same
-    # offset. If there is no box in between, then we can just check if they are on the
-    # same offset. We may do something more elegant later
-    if not box_inbetween and line_1['border'] != line_2['border']:
-      # We need to choose one line over the other
-      if scores[comb[0][0]] > scores[comb[1][0]]:
-        removed_lines.add(comb[1][0])
-      else:
-        removed_lines.add(comb[0][0])
+
+  for g, group in enumerate(groups):
+    for i in group:
+      if any([other is not None and other > (scores[i], i) for other in (left_best[g], right_best[g])]):
+        removed_lines.add(i)
 
   return removed_lines
 
+def get_box_edges(boxes, offset):
+  edges = []
+
+  for box in boxes:
+    edges.append(box[offset])
+    edges.append(box[offset] + box[offset + 2])
+
+  edges.sort()
+
+  return edges
+
+# Maximum of values over each (first, last) window, inclusive, or None if
+# it is empty. Both ends of the windows must never decrease.
+def get_window_maxes(values, windows):
+  maxes = []
+  window = deque()
+  next_idx = 0
+
+  for first, last in windows:
+    while next_idx <= last:
+      while len(window) > 0 and values[window[-1]] <= values[next_idx]:
+        window.pop()
+
+      window.append(next_idx)
+      next_idx += 1
+
+    while len(window) > 0 and window[0] < first:
+      window.popleft()
+
+    maxes.append(values[window[0]] if first <= last and len(window) > 0 else None)
+
+  return maxes
+
 def rate_lines(lines, boxes):
   horiz_lines = lines[0]
   vert_lines = lines[1]
@@ -151,74 +199,82 @@ def rate_lines(lines, boxes):
   return (horiz_scores, vert_scores)
 
 def calc_line_box_scores(lines, boxes, offset):
-  scores = []
-
-  for line in lines:
-    min_margin = float('inf')
-
-    num_intersections = 0
-    intersection_penalty = 0
-
-    for box in boxes:
-      first_edge = box[offset]
-      second_edge = box[offset] + box[offset + 2]
-
-      alt_offset = (offset + 1) % 2
-      first_alt_edge = box[alt_offset]
-      second_alt_edge = box[alt_offset + 2]
-
-
-      # We only want to consider the box if the line overlaps it somewhat
-      overlap = max(0, min(line['end'], second_alt_edge) - max(line['start'], first_alt_edge))
-
-      if overlap > 0:
-        # Calculate the minimum distance to either edge of this box
-        min_to_edge = min(abs(line['border'] - first_edge), abs(line['border'] - second_edge))
-  
-        # If it intersects the box, track that, and penalize based
-        # on how far into the box it is
-        if line['border'] >= first_edge and line['border'] <= second_edge:
-          num_intersections += 1
-          intersection_penalty += min_to_edge
-  
-        # Could track some sense of uniformity in the closest edges
-        # Although the case of this provides a problem:
-        #
-        # Line 1
-        # Line 2        Line 1      Line 1
-        # Line 3
-        #
-        # Because it would preference grid lines through cell 1
-  
-        # Check if this is the smallest margin, yet
-        if min_to_edge < min_margin:
-          min_margin = min_to_edge
-
-    score = min_margin - (num_intersections * intersection_penalty)
-
-    scores.append(score)
-
-  return scores
-
-def bin_value(line, bins, tolerance):
-  for bin in bins:
-    for bin_line in bin:
-      if abs(line['border'] - bin_line['border']) < tolerance:
-        bin.append(line)
-        return
-
-  # Not within tolerance of any bin
-  bins.append([line])
+  if len(lines) == 0:
+    return []
+
+  # Every line against every box at once, as (lines x boxes) arrays
+  coords = np.array([box[:4] for box in boxes], dtype=np.float64).reshape(-1, 4)
+  border = np.array([line['border'] for line in lines], dtype=np.float64)[:, None]
+  start = np.array([line['start'] for line in lines], dtype=np.float64)[:, None]
+  end = np.array([line['end'] for line in lines], dtype=np.float64)[:, None]
+
+  first_edge = coords[:, offset]
+  second_edge = coords[:, offset] + coords[:, offset + 2]
+
+  alt_offset = (offset + 1) % 2
+  first_alt_edge = coords[:, alt_offset]
+  second_alt_edge = coords[:, alt_offset + 2]
+
+  # We only want to consider the box if the line overlaps it somewhat
+  overlaps = np.minimum(end, second_alt_edge) - np.maximum(start, first_alt_edge) > 0
+
+  # Calculate the minimum distance to either edge of this box
+  min_to_edge = np.minimum(np.abs(border - first_edge), np.abs(border - second_edge))
+
+  # If it intersects the box, track that, and penalize based
+  # on how far into the box it is
+  intersects = overlaps & (border >= first_edge) & (border <= second_edge)
+  num_intersections = intersects.sum(axis=1)
+  intersection_penalty = np.where(intersects, min_to_edge, 0).sum(axis=1)
+
+  # Could track some sense of uniformity in the closest edges
+  # Although the case of this provides a problem:
+  #
+  # Line 1
+  # Line 2        Line 1      Line 1
+  # Line 3
+  #
+  # Because it would preference grid lines through cell 1
+
+  # The smallest margin to any box the line overlaps
+  if len(coords) == 0:
+    min_margin = np.full(len(lines), float('inf'))
+  else:
+    min_margin = np.where(overlaps, min_to_edge, float('inf')).min(axis=1)
+
+  scores = min_margin - (num_intersections * intersection_penalty)
+
+  return scores.tolist()
+
+# Sorts the lines by border, then sweeps through them, starting a new bin
+# whenever a line is not within tolerance of the previous one
+def bin_lines(lines, tolerance):
+  bins = []
+
+  for line in sorted(lines, key = lambda info: info['border']):
+    if len(bins) > 0 and line['border'] - bins[-1][-1]['border'] < tolerance:
+      bins[-1].append(line)
+    else:
+      bins.append([line])
+
+  return bins
 
 def display_bins(bins):
   if verbose:
     for bin in bins:
       print(bin)
 
+# Each bin becomes one line at the mean border, covering
+# the union of the extents of the lines in it
 def average_bins(bins):
   averaged_bins = []
   for bin in bins:
-    averaged_bins.append(sum(bin) / len(bin))
+    border = sum([line['border'] for line in bin]) * 1.0 / len(bin)
+    start = min([min(line['start'], line['end']) for line in bin])
+    end = max([max(line['start'], line['end']) for line in bin])
+
+    averaged_bins.append({'border': int(round(border)), 'start': int(start), 'end': int(end)})
 
   return averaged_bins
 
+
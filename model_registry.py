@@ -0,0 +1,21 @@
+import os
+import pickle
+
+# Models loaded by this process, keyed by absolute path, along with
+# the modification time of the file when it was loaded
+models = {}
+
+# Returns the unpickled model at path, loading it only the first time
+# it is requested, or again if the file has changed since
+def get_model(path):
+  key = os.path.abspath(path)
+  mtime = os.path.getmtime(key)
+
+  if key not in models or models[key][0] != mtime:
+    with open(key, 'rb') as f:
+      models[key] = (mtime, pickle.load(f))
+
+  return models[key][1]
+
+def clear():
+  models.clear()
@@ -0,0 +1,100 @@
+import numpy as np
+
+# Packs many cell crops into a few large images, so that they can be
+# read with one OCR request each rather than one per cell. Cells are
+# placed on shelves (rows of cells, as tall as their tallest cell), with
+# white gutters between them so words from neighbouring cells aren't
+# read together. The layout records where each cell went, so the words
+# found in a mosaic can be split back out to their cells.
+
+gutter = 20
+max_width = 2048
+max_height = 2048
+
+# Returns a list of mosaic layouts, each a dict with the mosaic's width
+# and height, and its cells, as dicts with the index of the cell in
+# sizes, and the x, y, w, h it is placed at. Sizes are (w, h) pairs.
+def pack_cells(sizes):
+  # Tallest first, so each shelf wastes little space above shorter cells
+  order = sorted(range(len(sizes)), key = lambda i: (-sizes[i][1], -sizes[i][0], i))
+
+  mosaics = []
+  layout = None
+
+  for i in order:
+    w, h = sizes[i]
+
+    if w <= 0 or h <= 0:
+      continue
+
+    if layout is not None:
+      shelf_x = layout['shelf_x'] + w + gutter
+      fits_shelf = shelf_x <= max_width or layout['shelf_x'] == gutter
+
+      if not fits_shelf:
+        # Start a new shelf below the current one
+        layout['shelf_y'] += layout['shelf_height'] + gutter
+        layout['shelf_x'] = gutter
+        layout['shelf_height'] = 0
+
+        if layout['shelf_y'] + h + gutter > max_height:
+          layout = None
+
+    if layout is None:
+      layout = {'width': 0, 'height': 0, 'cells': [], 'shelf_x': gutter, 'shelf_y': gutter, 'shelf_height': 0}
+      mosaics.append(layout)
+
+    layout['cells'].append({'index': i, 'x': layout['shelf_x'], 'y': layout['shelf_y'], 'w': w, 'h': h})
+
+    layout['shelf_x'] += w + gutter
+    layout['shelf_height'] = max(layout['shelf_height'], h)
+    layout['width'] = max(layout['width'], layout['shelf_x'])
+    layout['height'] = max(layout['height'], layout['shelf_y'] + layout['shelf_height'] + gutter)
+
+  for layout in mosaics:
+    del layout['shelf_x'], layout['shelf_y'], layout['shelf_height']
+
+  return mosaics
+
+# Draws the crops onto a white image, at the positions in the layout
+def build_mosaic(crops, layout):
+  channels = crops[layout['cells'][0]['index']].shape[2:]
+  mosaic = np.full((layout['height'], layout['width']) + channels, 255, dtype=np.uint8)
+
+  for cell in layout['cells']:
+    crop = crops[cell['index']]
+    mosaic[cell['y']:cell['y'] + cell['h'], cell['x']:cell['x'] + cell['w']] = crop[:cell['h'], :cell['w']]
+
+  return mosaic
+
+# Assigns each word (as a Vision text annotation) to the cell whose
+# placement contains the word's center. Returns a dict from cell index
+# to the words' text, in the order the words were given.
+def split_words(words, layout):
+  cell_words = {cell['index']: [] for cell in layout['cells']}
+
+  if len(words) == 0 or len(layout['cells']) == 0:
+    return cell_words
+
+  cells = np.array([[cell['x'], cell['y'], cell['x'] + cell['w'], cell['y'] + cell['h']] for cell in layout['cells']])
+
+  for word in words:
+    center_x, center_y = get_center(word)
+
+    inside = (cells[:, 0] <= center_x) & (center_x < cells[:, 2]) & (cells[:, 1] <= center_y) & (center_y < cells[:, 3])
+    found = np.flatnonzero(inside)
+
+    # Words centered in a gutter belong to no cell
+    if len(found) > 0:
+      cell_words[layout['cells'][found[0]]['index']].append(word['description'])
+
+  return cell_words
+
+# Center of a word's bounding polygon (missing coordinates are 0)
+def get_center(word):
+  vertices = word['boundingPoly']['vertices']
+
+  xs = [vertex.get('x', 0) for vertex in vertices]
+  ys = [vertex.get('y', 0) for vertex in vertices]
+
+  return ((min(xs) + max(xs)) / 2.0, (min(ys) + max(ys)) / 2.0)
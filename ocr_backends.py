@@ -0,0 +1,247 @@
+import os
+import csv
+import asyncio
+import subprocess
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+
+import oxford_api
+import ocr_cache
+import image_context
+import image_pyramid
+
+# OCR engines the pipeline can use. Each reads the words of a whole page,
+# in the format oxford_api returns and boxer.get_boxes_from_json reads
+# (regions of lines of words, each with a 'left,top,width,height'
+# boundingBox string, at the zoomed resolution), and the text of single
+# cells, in the labelled box format of cloud_api.add_labels.
+class OCRBackend(ABC):
+  name = None
+
+  # Word data for one image
+  @abstractmethod
+  def get_json_data(self, image, base_path, zoom_level, pref):
+    pass
+
+  # Word data for many images, as a dict of image to its data,
+  # or to the exception if it failed
+  def get_json_data_batch(self, images, base_path, zoom_level, pref):
+    loop = asyncio.new_event_loop()
+
+    try:
+      return loop.run_until_complete(self.get_json_data_async(images, base_path, zoom_level, pref))
+    finally:
+      loop.close()
+
+  @abstractmethod
+  async def get_json_data_async(self, images, base_path, zoom_level, pref):
+    pass
+
+  # Fills the cache for the images, reporting and returning any failures
+  def prefetch(self, images, base_path, zoom_level, pref):
+    results = self.get_json_data_batch(images, base_path, zoom_level, pref)
+    failures = [image for image in images if isinstance(results[image], Exception)]
+
+    for image in failures:
+      print('OCR failed for ' + image + ': ' + str(results[image]))
+
+    return failures
+
+  # Labels each box with the text inside it
+  @abstractmethod
+  def add_labels(self, boxes, ctx, info_dir, zoom_prefix, zoom_level):
+    pass
+
+# Words from the Oxford API, and cells from Google Cloud Vision. cloud_api
+# is only imported when cells are labelled, as the Google client libraries
+# it needs aren't installed where only the Tesseract backend is used.
+class OxfordBackend(OCRBackend):
+  name = 'oxford'
+
+  # Delay after each live Google request, in seconds. Oxford requests are
+  # paced by oxford_api's rate limit instead.
+  def __init__(self, cloud_delay = 0):
+    self.cloud_delay = cloud_delay
+
+  def get_json_data(self, image, base_path, zoom_level, pref):
+    return oxford_api.get_json_data(image, base_path, zoom_level, pref)
+
+  async def get_json_data_async(self, images, base_path, zoom_level, pref):
+    return await oxford_api.get_json_data_async(images, base_path, zoom_level, pref)
+
+  def add_labels(self, boxes, ctx, info_dir, zoom_prefix, zoom_level):
+    import cloud_api
+
+    return cloud_api.add_labels(boxes, ctx, info_dir + 'google_cache/' + zoom_prefix, zoom_level, self.cloud_delay, info_dir + ocr_cache.cache_name)
+
+# Words and cells from a local Tesseract install, with no network use.
+# Each call runs the tesseract executable, so many images (or cells) are
+# read at once, up to one per core.
+class TesseractBackend(OCRBackend):
+  name = 'tesseract'
+
+  def __init__(self, command = 'tesseract', lang = 'eng', page_psm = 3, cell_psm = 6, workers = None):
+    self.command = command
+    self.lang = lang
+    self.page_psm = page_psm
+    self.cell_psm = cell_psm
+    self.workers = workers if workers is not None else os.cpu_count()
+
+  def get_json_data(self, image, base_path, zoom_level, pref):
+    cache = ocr_cache.get_cache(pref + ocr_cache.cache_name)
+    key, img_data = self.get_image_key(image, base_path, zoom_level)
+
+    data = cache.get(key)
+
+    if data is None:
+      if img_data is None:
+        img_data = oxford_api.read_image_data(image, base_path, zoom_level)
+
+      data = read_page(self.get_args(self.page_psm, 'tsv'), img_data)
+      cache.put(key, self.name, data)
+
+    return data
+
+  # Pages are read by a pool of processes, as the parsing is
+  # done in Python, as well as the recognition in tesseract
+  async def get_json_data_async(self, images, base_path, zoom_level, pref):
+    cache = ocr_cache.get_cache(pref + ocr_cache.cache_name)
+
+    # The uncached pages are sent with the data read for their keys
+    results, uncached = ocr_cache.lookup_images(cache, images, lambda image: self.get_image_key(image, base_path, zoom_level))
+
+    if len(uncached) == 0:
+      return results
+
+    loop = asyncio.get_event_loop()
+    args = self.get_args(self.page_psm, 'tsv')
+
+    with ProcessPoolExecutor(self.workers) as executor:
+      tasks = [loop.run_in_executor(executor, read_page, args, img_data if img_data is not None else oxford_api.read_image_data(image, base_path, zoom_level)) for image, key, img_data in uncached]
+      fetched = await asyncio.gather(*tasks, return_exceptions=True)
+
+    cache.put_many([(key, self.name, data) for (image, key, img_data), data in zip(uncached, fetched) if not isinstance(data, Exception)])
+    results.update((image, data) for (image, key, img_data), data in zip(uncached, fetched))
+
+    return results
+
+  # Cells are read by threads, which only wait on tesseract, so this
+  # also works inside the daemonic workers of a multiprocessing pool
+  def add_labels(self, boxes, ctx, info_dir, zoom_prefix, zoom_level):
+    cache = ocr_cache.get_cache(info_dir + ocr_cache.cache_name)
+    engine = self.name + '_cell'
+    params = self.get_cell_params()
+
+    contents = [cv2.imencode('.png', image_context.get_cell_crop(ctx, box, zoom_level))[1].tobytes() for box in boxes]
+    keys = [ocr_cache.get_key(engine, params, content) for content in contents]
+
+    labels = cache.get_many(keys)
+    uncached = [i for i, key in enumerate(keys) if key not in labels]
+
+    if len(uncached) > 0:
+      args = self.get_args(self.cell_psm, None)
+
+      with ThreadPoolExecutor(self.workers) as executor:
+        texts = list(executor.map(lambda i: read_cell(args, contents[i]), uncached))
+
+      cache.put_many([(keys[i], engine, text) for i, text in zip(uncached, texts)])
+      labels.update((keys[i], text) for i, text in zip(uncached, texts))
+
+    return [(box[0], box[1], box[2], box[3], [labels[key]]) for box, key in zip(boxes, keys)]
+
+  # Returns (key, image data), the data only read if the key isn't known yet
+  def get_image_key(self, image, base_path, zoom_level):
+    return ocr_cache.get_image_key(self.name, self.get_page_params(), image_pyramid.get_path(base_path, image, zoom_level), lambda: oxford_api.read_image_data(image, base_path, zoom_level))
+
+  def get_args(self, psm, config):
+    args = [self.command, 'stdin', 'stdout', '-l', self.lang, '--psm', str(psm)]
+
+    if config is not None:
+      args.append(config)
+
+    return args
+
+  def get_page_params(self):
+    return 'lang=' + self.lang + ' psm=' + str(self.page_psm)
+
+  def get_cell_params(self):
+    return 'lang=' + self.lang + ' psm=' + str(self.cell_psm)
+
+# Runs tesseract on the image, returning its output as text
+def run_tesseract(args, img_data):
+  # Each run is one of many in parallel, so shouldn't use several threads itself
+  env = dict(os.environ, OMP_THREAD_LIMIT='1')
+
+  result = subprocess.run(args, input=img_data, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+
+  if result.returncode != 0:
+    raise OSError('tesseract failed (' + str(result.returncode) + '): ' + result.stderr.decode('utf-8', 'replace').strip())
+
+  return result.stdout.decode('utf-8')
+
+def read_page(args, img_data):
+  return tsv_to_json(run_tesseract(args, img_data))
+
+def read_cell(args, img_data):
+  return ' '.join(run_tesseract(args, img_data).split())
+
+# Converts tesseract's TSV output to the Oxford format, with a region for
+# each of tesseract's blocks, and a line for each of its lines
+def tsv_to_json(tsv):
+  regions = []
+  region_lines = {}
+  lines = {}
+
+  for row in csv.DictReader(tsv.splitlines(), delimiter='\t', quoting=csv.QUOTE_NONE):
+    # Level 5 rows are words; the rest are pages, blocks, paragraphs and lines
+    if row['level'] != '5' or row['text'] is None or row['text'].strip() == '':
+      continue
+
+    block = row['block_num']
+    line = (block, row['par_num'], row['line_num'])
+    bbox = [int(row[name]) for name in ('left', 'top', 'width', 'height')]
+
+    if block not in region_lines:
+      region_lines[block] = []
+      regions.append({'lines': region_lines[block]})
+
+    if line not in lines:
+      lines[line] = {'words': []}
+      region_lines[block].append(lines[line])
+
+    lines[line]['words'].append({'boundingBox': get_bbox_string(bbox), 'text': row['text'].strip()})
+
+  for region in regions:
+    for line in region['lines']:
+      line['boundingBox'] = get_bbox_string(get_union([parse_bbox(word['boundingBox']) for word in line['words']]))
+
+    region['boundingBox'] = get_bbox_string(get_union([parse_bbox(line['boundingBox']) for line in region['lines']]))
+
+  return {'language': 'en', 'regions': regions}
+
+def get_bbox_string(bbox):
+  return ','.join([str(x) for x in bbox])
+
+def parse_bbox(bbox):
+  return [int(x) for x in bbox.split(',')]
+
+def get_union(bboxes):
+  left = min([bbox[0] for bbox in bboxes])
+  top = min([bbox[1] for bbox in bboxes])
+  right = max([bbox[0] + bbox[2] for bbox in bboxes])
+  bottom = max([bbox[1] + bbox[3] for bbox in bboxes])
+
+  return [left, top, right - left, bottom - top]
+
+backends = {
+  'oxford': OxfordBackend,
+  'tesseract': TesseractBackend
+}
+
+def get_backend(name, **kwargs):
+  if name not in backends:
+    raise ValueError('Unknown OCR backend: ' + name + ' (expected one of ' + ', '.join(sorted(backends)) + ')')
+
+  return backends[name](**kwargs)
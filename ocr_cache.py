@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+import dir_helper
+
+# OCR responses, stored in one SQLite database, keyed by a hash of the
+# OCR engine, its parameters and the exact image bytes sent. The same
+# content is then only read once, whatever image or box it came from.
+# Entries carry their size and last access time, so the least recently
+# used can be dropped once the cache grows past max_bytes.
+
+cache_name = 'ocr_cache.sqlite'
+
+# None to never evict
+max_bytes = None
+
+# When evicting, shrink to this fraction of max_bytes, so that
+# eviction doesn't run again on the very next write
+evict_ratio = 0.9
+
+# Lookups per query, under SQLite's limit on query parameters
+lookup_chunk_size = 500
+
+def get_key(engine, params, content):
+  digest = hashlib.sha256()
+
+  for part in (engine, params):
+    part = part.encode('utf-8')
+    digest.update(str(len(part)).encode('ascii') + b':' + part)
+
+  digest.update(content)
+
+  return digest.hexdigest()
+
+# Keys already worked out for images, by (engine, params, image path), so
+# that an image read once (by a prefetch, say) isn't encoded again only to
+# find its key. Kept for the life of the process, and inherited by forks.
+image_keys = {}
+
+# Returns (key, content) for the image at path, where content is what
+# read_content returns, or None if the key was already known
+def get_image_key(engine, params, path, read_content):
+  memo_key = (engine, params, path)
+
+  if memo_key in image_keys:
+    return (image_keys[memo_key], None)
+
+  content = read_content()
+  image_keys[memo_key] = get_key(engine, params, content)
+
+  return (image_keys[memo_key], content)
+
+class OCRCache:
+  def __init__(self, path, evictable = True):
+    dir_helper.ensure(path)
+
+    self.path = path
+    self.evictable = evictable
+    self.pid = os.getpid()
+    self.lock = threading.Lock()
+    self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+
+    # WAL lets worker processes read while another writes
+    self.conn.execute('PRAGMA journal_mode=WAL')
+    self.conn.execute('PRAGMA synchronous=NORMAL')
+    self.conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+      key TEXT PRIMARY KEY,
+      engine TEXT NOT NULL,
+      data TEXT NOT NULL,
+      size INTEGER NOT NULL,
+      accessed REAL NOT NULL)''')
+    self.conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+    self.conn.commit()
+
+  def get(self, key):
+    return self.get_many([key]).get(key)
+
+  # Returns a dict of key to response, for the keys that are cached
+  def get_many(self, keys):
+    keys = list(set(keys))
+    found = {}
+
+    with self.lock:
+      for start in range(0, len(keys), lookup_chunk_size):
+        chunk = keys[start:start + lookup_chunk_size]
+        rows = self.conn.execute('SELECT key, data FROM responses WHERE key IN (' + ','.join('?' * len(chunk)) + ')', chunk)
+
+        for key, data in rows:
+          found[key] = json.loads(data)
+
+      if len(found) > 0:
+        now = time.time()
+        self.conn.executemany('UPDATE responses SET accessed = ? WHERE key = ?', [(now, key) for key in found])
+        self.conn.commit()
+
+    return found
+
+  def put(self, key, engine, response):
+    self.put_many([(key, engine, response)])
+
+  # Stores (key, engine, response) entries, then evicts if over max_bytes
+  def put_many(self, entries):
+    now = time.time()
+    rows = []
+
+    for key, engine, response in entries:
+      data = json.dumps(response)
+      rows.append((key, engine, data, len(data), now))
+
+    with self.lock:
+      self.conn.executemany('INSERT OR REPLACE INTO responses (key, engine, data, size, accessed) VALUES (?, ?, ?, ?, ?)', rows)
+      self.conn.commit()
+
+      if self.evictable and max_bytes is not None:
+        self.evict(max_bytes)
+
+  # Drops the least recently used entries until the total is under the
+  # limit. Called with the lock held.
+  def evict(self, limit):
+    total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    if total <= limit:
+      return
+
+    target = total - int(limit * evict_ratio)
+    removed = 0
+    doomed = []
+
+    for key, size in self.conn.execute('SELECT key, size FROM responses ORDER BY accessed'):
+      if removed >= target:
+        break
+
+      doomed.append((key,))
+      removed += size
+
+    self.conn.executemany('DELETE FROM responses WHERE key = ?', doomed)
+    self.conn.commit()
+
+  def close(self):
+    with self.lock:
+      self.conn.close()
+
+# Looks up many images a chunk at a time, given a function returning the
+# (key, content) of an image as get_image_key does. Returns a dict of image
+# to its cached response, and a list of (image, key, content) for the rest,
+# so only the content of images that aren't cached is held on to.
+def lookup_images(cache, images, get_image_key):
+  results = {}
+  uncached = []
+
+  for start in range(0, len(images), lookup_chunk_size):
+    chunk = [(image,) + get_image_key(image) for image in images[start:start + lookup_chunk_size]]
+    cached = cache.get_many([key for image, key, content in chunk])
+
+    for image, key, content in chunk:
+      if key in cached:
+        results[image] = cached[key]
+      else:
+        uncached.append((image, key, content))
+
+  return (results, uncached)
+
+# Open caches, by path, shared by everything in this process
+caches = {}
+
+def get_cache(path):
+  # A connection can't be shared with a forked worker, so it opens its own
+  if path not in caches or caches[path].pid != os.getpid():
+    caches[path] = OCRCache(path)
+
+  return caches[path]
+
+def clear():
+  for cache in caches.values():
+    cache.close()
+
+  caches.clear()
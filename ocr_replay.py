@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import random
+import threading
+import http.client
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import ocr_cache
+import rate_limit
+
+# Record and replay of OCR API traffic, for benchmarking without the real
+# services. In record mode, every response from the Oxford and Google
+# APIs is saved, keyed by a hash of the request. In replay mode, requests
+# go to a local server instead, which answers with the saved responses,
+# and can add latency, server errors and 429s to see how the pipeline
+# copes with them. The mode and settings can be set from the environment.
+
+# 'live', 'record' or 'replay'
+mode = os.environ.get('OCR_MODE', 'live')
+
+recording_path = os.environ.get('OCR_RECORDING', 'ocr_recording.sqlite')
+
+# Seconds added to each replayed response
+latency = float(os.environ.get('OCR_REPLAY_LATENCY', '0'))
+
+# Fractions of replayed requests answered with a 503 or a 429
+error_rate = float(os.environ.get('OCR_REPLAY_ERROR_RATE', '0'))
+throttle_rate = float(os.environ.get('OCR_REPLAY_THROTTLE_RATE', '0'))
+
+# Retry-After sent with injected 429s
+retry_after = 1
+
+# A replayed request that failed, with its status, and the seconds from
+# its Retry-After header if it had one
+class ReplayError(Exception):
+  def __init__(self, message, status = None, retry_after = None):
+    super().__init__(message)
+    self.status = status
+    self.retry_after = retry_after
+
+def get_key(service, path, body):
+  return ocr_cache.get_key(service, path, body)
+
+# Recordings are never evicted
+recording = None
+
+def get_recording():
+  global recording
+
+  if recording is None or recording.pid != os.getpid():
+    recording = ocr_cache.OCRCache(recording_path, evictable=False)
+
+  return recording
+
+def record(service, path, body, status, response_body):
+  get_recording().put(get_key(service, path, body), service, {
+    'status': status,
+    'body': response_body.decode('utf-8')
+  })
+
+class ReplayHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def do_POST(self):
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    service = self.path.split('/')[1]
+
+    time.sleep(latency)
+
+    chance = random.random()
+
+    if chance < throttle_rate:
+      self.respond(429, b'{"statusCode": 429, "message": "Rate limit is exceeded."}', {'Retry-After': str(retry_after)})
+    elif chance < throttle_rate + error_rate:
+      self.respond(503, b'{"statusCode": 503, "message": "Injected error."}')
+    else:
+      # The service is in the path twice: once to route it here, then as recorded
+      saved = get_recording().get(get_key(service, self.path[len(service) + 1:], body))
+
+      if saved is None:
+        self.respond(404, b'{"statusCode": 404, "message": "No recorded response."}')
+      else:
+        self.respond(saved['status'], saved['body'].encode('utf-8'))
+
+  def respond(self, status, body, headers = {}):
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+
+    for name, value in headers.items():
+      self.send_header(name, value)
+
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+# Started on first use, and kept for the life of the process
+server = None
+
+def get_server():
+  global server
+
+  if server is None:
+    server = ReplayServer(('127.0.0.1', 0), ReplayHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+  return server
+
+# (host, port) of the replay server
+def get_address():
+  return get_server().server_address
+
+def stop():
+  global server
+
+  if server is not None:
+    server.shutdown()
+    server.server_close()
+    server = None
+
+# Sends a JSON request to the replay server, as the given service
+def post_json(service, path, body):
+  host, port = get_address()
+  conn = http.client.HTTPConnection(host, port)
+
+  try:
+    conn.request('POST', '/' + service + path, encode_json(body), {'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    data = response.read()
+  finally:
+    conn.close()
+
+  if response.status != 200:
+    raise ReplayError('Replayed ' + service + ' request failed with status ' + str(response.status), response.status, rate_limit.get_retry_after(response.getheader('Retry-After')))
+
+  return json.loads(data.decode('utf-8'))
+
+# The same body always encodes the same way, so it has the same key
+def encode_json(body):
+  return json.dumps(body, sort_keys=True).encode('utf-8')
@@ -1,18 +1,66 @@
 import json
 import time
 import os
+import asyncio
 import http.client, urllib.request, urllib.parse, urllib.error, base64
+from concurrent.futures import ThreadPoolExecutor
 import sub_key
-import dir_helper
+import rate_limit
+import ocr_cache
+import ocr_replay
+import image_pyramid
 
+# Only read now, to copy older per-image cache files into the OCR cache
 json_cache_path = 'json_cache'
 
-# API vars
-headers = {
-    # Request headers
-    'Content-Type': 'application/octet-stream',
-    'Ocp-Apim-Subscription-Key': sub_key.get_key(),
-}
+engine = 'oxford'
+
+host = 'api.projectoxford.ai'
+port = None
+use_https = True
+api_path = '/vision/v1/ocr'
+timeout = 10
+
+# Should match the subscription's quota
+requests_per_minute = 20
+burst_size = 5
+
+# Requests in flight at once, and connections kept open, in batch mode
+max_in_flight = 4
+
+# Retries on connection errors, 429s and server errors, before giving up
+max_retries = 5
+backoff_base = 1.0
+backoff_cap = 60.0
+
+# Shared by every request from this process
+bucket = rate_limit.TokenBucket(requests_per_minute / 60.0, burst_size)
+
+# Gives this process an equal share of the rate limit, for when each of
+# several processes has its own copy of it (as forked workers do), so that
+# together they still keep to it
+def share_rate_limit(shares):
+  global bucket
+
+  bucket = rate_limit.TokenBucket(requests_per_minute / 60.0 / shares, max(1.0, burst_size / shares))
+
+class OCRRequestError(Exception):
+  pass
+
+# API vars, with the key only read when the first request is sent
+headers = None
+
+def get_headers():
+  global headers
+
+  if headers is None:
+    headers = {
+        # Request headers
+        'Content-Type': 'application/octet-stream',
+        'Ocp-Apim-Subscription-Key': sub_key.get_key() if ocr_replay.mode != 'replay' else 'replay',
+    }
+
+  return headers
 
 params = urllib.parse.urlencode({
     # Request parameters
@@ -20,44 +68,211 @@ params = urllib.parse.urlencode({
     'detectOrientation ': 'true',
 })
 
-def get_json_data(image, base_path, zoom_level, pref, sleep_delay):
-  zoom_prefix = str(zoom_level) + 'x/' if zoom_level > 1 else ''
-  json_cache_file = pref + json_cache_path + '/' + zoom_prefix + image + '.json'
+def get_json_data(image, base_path, zoom_level, pref):
+  cache = ocr_cache.get_cache(pref + ocr_cache.cache_name)
+  key, img_data = get_image_key(image, base_path, zoom_level)
 
-  if os.path.isfile(json_cache_file):
-    with open(json_cache_file, 'r') as j_file:
-      data = json.loads(j_file.read())
+  data = get_cached_data(cache, key, image, zoom_level, pref)
 
-    if 'statusCode' not in data or data['statusCode'] != 429:
-      return data
+  if data is not None:
+    return data
 
-  with open(base_path + '/' + zoom_prefix + image, 'rb') as img_file:
-    img_data = img_file.read()
+  if img_data is None:
+    img_data = read_image_data(image, base_path, zoom_level)
 
-  data = None
+  conn = None
 
-  while data is None:
-    conn = None
-    try:
-      conn = http.client.HTTPSConnection('api.projectoxford.ai', timeout=10)
-      conn.request("POST", "/vision/v1/ocr?%s" % params, img_data, headers)
-      response = conn.getresponse()
-      data = response.read()
+  try:
+    for attempt in range(max_retries + 1):
+      bucket.acquire()
+
+      if conn is None:
+        conn = get_connection()
+
+      status, retry_after, body, conn = send_request(conn, img_data)
+
+      if not should_retry(status):
+        break
+
+      time.sleep(get_retry_delay(attempt, status, retry_after))
+  finally:
+    if conn is not None:
+      conn.close()
+
+  json_data = get_response_data(image, status, body)
+
+  store_data(cache, key, json_data)
+
+  return json_data
+
+# Fetches any uncached OCR data for the images concurrently, with up to
+# max_in_flight requests on reused connections, filling the cache.
+# Returns a dict of image to its data, or to the exception if it failed.
+async def get_json_data_async(images, base_path, zoom_level, pref):
+  cache = ocr_cache.get_cache(pref + ocr_cache.cache_name)
+
+  # Look up every image at once, then only fetch the rest, with the data
+  # read for their keys
+  results, uncached = ocr_cache.lookup_images(cache, images, lambda image: get_image_key(image, base_path, zoom_level))
+
+  connections = []
+  semaphore = asyncio.Semaphore(max_in_flight)
+  executor = ThreadPoolExecutor(max_in_flight)
+
+  try:
+    tasks = [fetch_async(image, key, img_data, base_path, zoom_level, pref, cache, connections, semaphore, executor) for image, key, img_data in uncached]
+    fetched = await asyncio.gather(*tasks, return_exceptions=True)
+  finally:
+    executor.shutdown()
+
+    for conn in connections:
       conn.close()
-    except Exception as e:
-      print("[Errno {0}] {1}".format(e.errno, e.strerror))
-      data = None
-    else:
+
+  results.update((image, data) for (image, key, img_data), data in zip(uncached, fetched))
+
+  return results
+
+# img_data is None if it wasn't read for the key, so is read here
+async def fetch_async(image, key, img_data, base_path, zoom_level, pref, cache, connections, semaphore, executor):
+  data = get_cached_data(cache, key, image, zoom_level, pref)
+
+  if data is not None:
+    return data
+
+  if img_data is None:
+    img_data = read_image_data(image, base_path, zoom_level)
+
+  loop = asyncio.get_event_loop()
+
+  for attempt in range(max_retries + 1):
+    await bucket.acquire_async()
+
+    async with semaphore:
+      # Idle connections are reused; the semaphore bounds how many there are
+      conn = connections.pop() if len(connections) > 0 else get_connection()
+
+      status, retry_after, body, conn = await loop.run_in_executor(executor, send_request, conn, img_data)
+
       if conn is not None:
-        conn.close()
-        conn = None
+        connections.append(conn)
+
+    if not should_retry(status):
+      break
 
-  json_data = json.loads(data.decode('utf-8')) # Need to double-check if utf-8 is correct
+    await asyncio.sleep(get_retry_delay(attempt, status, retry_after))
 
-  dir_helper.ensure(json_cache_file)
-  with open(json_cache_file, 'w') as json_file:
-    json.dump(json_data, json_file)
+  json_data = get_response_data(image, status, body)
 
-  time.sleep(sleep_delay)
+  store_data(cache, key, json_data)
 
   return json_data
+
+def get_connection():
+  if ocr_replay.mode == 'replay':
+    replay_host, replay_port = ocr_replay.get_address()
+    return http.client.HTTPConnection(replay_host, replay_port, timeout=timeout)
+
+  if use_https:
+    return http.client.HTTPSConnection(host, port, timeout=timeout)
+
+  return http.client.HTTPConnection(host, port, timeout=timeout)
+
+def get_request_path():
+  request_path = api_path + '?' + params
+
+  # The replay server serves several APIs, so it needs to know which this is
+  if ocr_replay.mode == 'replay':
+    return '/' + engine + request_path
+
+  return request_path
+
+# Posts the image on the connection, returning (status, retry after, body,
+# connection), with a status of None if the request failed. The connection
+# is None if it can't be reused.
+def send_request(conn, img_data):
+  try:
+    conn.request("POST", get_request_path(), img_data, get_headers())
+    response = conn.getresponse()
+    body = response.read()
+  except (http.client.HTTPException, OSError) as e:
+    print('OCR request failed: ' + str(e))
+    conn.close()
+    return (None, None, None, None)
+
+  # Retryable failures aren't kept, as replay makes its own
+  if ocr_replay.mode == 'record' and not should_retry(response.status):
+    ocr_replay.record(engine, api_path + '?' + params, img_data, response.status, body)
+
+  retry_after = rate_limit.get_retry_after(response.getheader('Retry-After'))
+
+  if response.getheader('Connection', '').lower() == 'close':
+    conn.close()
+    conn = None
+
+  return (response.status, retry_after, body, conn)
+
+def should_retry(status):
+  return status is None or status == 429 or status >= 500
+
+def get_retry_delay(attempt, status, retry_after):
+  delay = rate_limit.get_backoff_delay(attempt, backoff_base, backoff_cap)
+
+  if status == 429:
+    # Everything else waits too, rather than adding to the problem
+    wait = retry_after if retry_after is not None else delay
+    bucket.pause(wait)
+
+    return max(delay, wait)
+
+  return delay
+
+def get_response_data(image, status, body):
+  if should_retry(status):
+    raise OCRRequestError('Gave up on ' + image + ' after ' + str(max_retries + 1) + ' attempts (last status: ' + str(status) + ')')
+
+  return json.loads(body.decode('utf-8')) # Need to double-check if utf-8 is correct
+
+def get_key(img_data):
+  return ocr_cache.get_key(engine, params, img_data)
+
+# Returns (key, image data), the data only read if the key isn't known yet
+def get_image_key(image, base_path, zoom_level):
+  return ocr_cache.get_image_key(engine, params, image_pyramid.get_path(base_path, image, zoom_level), lambda: read_image_data(image, base_path, zoom_level))
+
+# Returns the cached data, or None if there isn't any. Anything only
+# in the older per-image cache files is copied into the OCR cache.
+def get_cached_data(cache, key, image, zoom_level, pref):
+  data = cache.get(key)
+
+  if data is None:
+    data = read_cache(get_cache_file(image, zoom_level, pref))
+
+    if data is not None:
+      store_data(cache, key, data)
+
+  return data
+
+# 429s aren't kept, so the request is tried again next time
+def store_data(cache, key, json_data):
+  if 'statusCode' not in json_data or json_data['statusCode'] != 429:
+    cache.put(key, engine, json_data)
+
+def get_cache_file(image, zoom_level, pref):
+  zoom_prefix = str(zoom_level) + 'x/' if zoom_level > 1 else ''
+
+  return pref + json_cache_path + '/' + zoom_prefix + image + '.json'
+
+# Returns the data in an older cache file, or None if there isn't any (or it was a 429)
+def read_cache(json_cache_file):
+  if os.path.isfile(json_cache_file):
+    with open(json_cache_file, 'r') as j_file:
+      data = json.loads(j_file.read())
+
+    if 'statusCode' not in data or data['statusCode'] != 429:
+      return data
+
+  return None
+
+# Scaled from the base image if there's no file at this zoom
+def read_image_data(image, base_path, zoom_level):
+  return image_pyramid.get_encoded(base_path, image, zoom_level)
@@ -0,0 +1,101 @@
+import numpy as np
+
+# Constant-time maximum over any rectangle of an image, using a 2D sparse
+# table: level (ky, kx) holds the maximum of each 2^ky by 2^kx block, so
+# any rectangle is covered by four (overlapping) blocks of one level.
+# The levels aren't kept: each query_batch makes them one step at a time,
+# each from the one before, answering the rectangles of each level as it
+# goes, so no more than four image-sized levels are held at once.
+# If img only covers part of a larger image, origin is the (x, y) of its top
+# left corner, and queries are in the coordinates of the larger image.
+class RangeMax:
+  def __init__(self, img, origin = (0, 0)):
+    self.img = img
+    self.origin = origin
+
+  # Maximum of img[top:bot + 1, left:right + 1], as with slicing, or 0
+  # if that is empty (after clipping to the covered region)
+  def query(self, left, top, right, bot):
+    return self.query_batch(np.array([left]), np.array([top]), np.array([right]), np.array([bot]))[0]
+
+  # Vectorized query, over arrays of equal length
+  def query_batch(self, left, top, right, bot):
+    height, width = self.img.shape[:2]
+
+    # Translate, then clip to the image, the same way slicing does
+    left = np.clip(np.asarray(left, dtype=np.intp) - self.origin[0], 0, width)
+    top = np.clip(np.asarray(top, dtype=np.intp) - self.origin[1], 0, height)
+    right = np.clip(np.asarray(right, dtype=np.intp) - self.origin[0], -1, width - 1)
+    bot = np.clip(np.asarray(bot, dtype=np.intp) - self.origin[1], -1, height - 1)
+
+    values = np.zeros(len(left), dtype=self.img.dtype)
+    valid = (left <= right) & (top <= bot)
+
+    if not valid.any():
+      return values
+
+    left = left[valid]
+    top = top[valid]
+    right = right[valid]
+    bot = bot[valid]
+
+    ky = floor_log2(bot - top + 1)
+    kx = floor_log2(right - left + 1)
+
+    found = np.zeros(len(left), dtype=self.img.dtype)
+
+    # Each row of levels, (0, kx) to (max ky, kx), starts from the one
+    # level (0, kx) kept from the row before
+    row_start = self.img
+
+    for level_x in range(int(kx.max()) + 1):
+      if level_x > 0:
+        row_start = get_next_level(row_start, level_x, 1)
+
+      in_row = kx == level_x
+
+      if not in_row.any():
+        continue
+
+      level = row_start
+
+      for level_y in range(int(ky[in_row].max()) + 1):
+        if level_y > 0:
+          level = get_next_level(level, level_y, 0)
+
+        group = in_row & (ky == level_y)
+
+        if not group.any():
+          continue
+
+        far_top = bot[group] - (1 << level_y) + 1
+        far_left = right[group] - (1 << level_x) + 1
+
+        found[group] = np.maximum(
+          np.maximum(level[top[group], left[group]], level[top[group], far_left]),
+          np.maximum(level[far_top, left[group]], level[far_top, far_left]))
+
+    values[valid] = found
+
+    return values
+
+# The level 2^k blocks across (axis 1) or down (axis 0), from the level
+# of 2^(k - 1) blocks
+def get_next_level(prev, k, axis):
+  step = 1 << (k - 1)
+
+  if axis == 1:
+    return np.maximum(prev[:, :-step], prev[:, step:])
+
+  return np.maximum(prev[:-step], prev[step:])
+
+def floor_log2(values):
+  logs = np.zeros(len(values), dtype=np.intp)
+  values = values.copy()
+
+  while (values > 1).any():
+    bigger = values > 1
+    logs[bigger] += 1
+    values[bigger] >>= 1
+
+  return logs
@@ -0,0 +1,71 @@
+import asyncio
+import random
+import threading
+import time
+from email.utils import mktime_tz, parsedate_tz
+
+# Token bucket rate limiter, allowing bursts of up to capacity requests,
+# refilled at rate requests per second. Safe to share between threads.
+class TokenBucket:
+  def __init__(self, rate, capacity):
+    self.rate = rate
+    self.capacity = capacity
+    self.tokens = capacity
+    self.updated = time.time()
+    self.lock = threading.Lock()
+
+  # Takes a token if there is one, returning 0, or else
+  # returns the time until the next one is available
+  def try_acquire(self):
+    with self.lock:
+      now = time.time()
+      self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+
+      if self.tokens >= 1:
+        self.tokens -= 1
+        return 0.0
+
+      return (1 - self.tokens) / self.rate
+
+  def acquire(self):
+    wait = self.try_acquire()
+
+    while wait > 0:
+      time.sleep(wait)
+      wait = self.try_acquire()
+
+  async def acquire_async(self):
+    wait = self.try_acquire()
+
+    while wait > 0:
+      await asyncio.sleep(wait)
+      wait = self.try_acquire()
+
+  # Holds back every request for the given time, e.g. after a 429
+  def pause(self, seconds):
+    with self.lock:
+      self.tokens = min(self.tokens, 0.0) - seconds * self.rate
+
+# Exponential backoff with full jitter: a random delay of up to
+# base * 2^attempt seconds, capped
+def get_backoff_delay(attempt, base, cap):
+  return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+# Seconds to wait from a Retry-After header, given either as
+# seconds or as an HTTP date, or None if missing or unreadable
+def get_retry_after(value):
+  if value is None:
+    return None
+
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+
+  parsed = parsedate_tz(value)
+
+  if parsed is None:
+    return None
+
+  return max(0.0, mktime_tz(parsed) - time.time())
@@ -1,4 +1,4 @@
-from itertools import combinations
+import numpy as np
 
 import clusterer
 
@@ -51,76 +51,31 @@ def translate_clusters(clusters):
 
   return combined
 
-def rate_combinations(boxes, lines):
-  overall_row_scores = {}
-  row_score_matrix = [[1.0 for x in range(len(boxes))] for y in range(len(boxes))]
-  overall_col_scores = {}
-  col_score_matrix = [[1.0 for x in range(len(boxes))] for y in range(len(boxes))]
-  horiz_lines = lines[0]
-  vert_lines = lines[1]
-
-  for comb in combinations(enumerate(boxes), 2):
-    row_scores = {}
-    col_scores = {}
-
-    i = comb[0][0]
-    j = comb[1][0]
-
-    box_1 = {
-      'left': comb[0][1][0],
-      'right': comb[0][1][0] + comb[0][1][2],
-      'top': comb[0][1][1],
-      'bottom': comb[0][1][1] + comb[0][1][3]
-    }
-
-    box_2 = {
-      'left': comb[1][1][0],
-      'right': comb[1][1][0] + comb[1][1][2],
-      'top': comb[1][1][1],
-      'bottom': comb[1][1][1] + comb[1][1][3]
-    }
-
-    # 1.) Their vertical (horizontal) centers align
-    # May want to cut the factor down to 1.0 to make it a max of 1.0
-    row_scores['center_align'] = 2.0 / (1.0 + abs(box_1['top'] + box_1['bottom'] - box_2['top'] - box_2['bottom']))
-    col_scores['center_align'] = 2.0 / (1.0 + abs(box_1['left'] + box_1['right'] - box_2['left'] - box_2['right']))
-
-    # 2.) Their left (top) edges align
-    row_scores['top_align'] = 1.0 / (1.0 + abs(box_1['top'] - box_2['top']))
-    col_scores['left_align'] = 1.0 / (1.0 + abs(box_1['left'] - box_2['left']))
-
-    # 3.) Their right (bottom) edges align
-    row_scores['bottom_align'] = 1.0 / (1.0 + abs(box_1['bottom'] - box_2['bottom']))
-    col_scores['right_align'] = 1.0 / (1.0 + abs(box_1['right'] - box_2['right']))
+# Pairs with a row (col) score of at least this are considered compatible
+score_threshold = 1.0
 
-    # 4.) If there is a line close to their left (above them)
-    row_scores['top_line'] = calculate_preceding_line_score(box_1['top'], box_2['top'], horiz_lines)
-    col_scores['left_line'] = calculate_preceding_line_score(box_1['left'], box_2['left'], vert_lines)
+# Build the scores as above-threshold pairs instead of full matrices
+sparse_scores = False
 
-    # 5.) If there is a line close to their right (below them)
-    row_scores['bottom_line'] = calculate_succeeding_line_score(box_1['bottom'], box_2['bottom'], horiz_lines)
-    col_scores['right_line'] = calculate_succeeding_line_score(box_1['right'], box_2['right'], vert_lines)
+# Number of boxes whose scores against all other boxes are computed at once
+score_block_size = 256
 
-    # 6.) They overlap significantly in their horizontal (vertical) range
-    row_scores['vert_overlap'] = calculate_vertical_overlap(box_1, box_2)
-    col_scores['horiz_overlap'] = calculate_horizontal_overlap(box_1, box_2)
-
-    # 7.) I would like to add in a term regarding a shared strong score with a third object
-
-    row_score = calculate_row_score(row_scores)
-    col_score = calculate_col_score(col_scores)
+def rate_combinations(boxes, lines):
+  coords = get_box_array(boxes)
+  horiz_borders = get_sorted_borders(lines[0])
+  vert_borders = get_sorted_borders(lines[1])
 
-    overall_row_scores[str(comb)] = row_score
-    overall_col_scores[str(comb)] = col_score
+  if sparse_scores:
+    row_edges, col_edges = get_score_edges(coords, horiz_borders, vert_borders, score_threshold)
 
-    row_score_matrix[comb[0][0]][comb[1][0]] = row_score
-    row_score_matrix[comb[1][0]][comb[0][0]] = row_score
-    col_score_matrix[comb[0][0]][comb[1][0]] = col_score
-    col_score_matrix[comb[1][0]][comb[0][0]] = col_score
+    row_clusters = clusterer.newer_cluster_edges(len(boxes), row_edges[0], row_edges[1])
+    col_clusters = clusterer.newer_cluster_edges(len(boxes), col_edges[0], col_edges[1])
+  else:
+    row_score_matrix, col_score_matrix = get_score_matrices(coords, horiz_borders, vert_borders, score_threshold)
 
-  # Might want to do 0.999 later
-  row_clusters = clusterer.newer_cluster_scores(row_score_matrix, 1.0)
-  col_clusters = clusterer.newer_cluster_scores(col_score_matrix, 1.0)
+    # Might want to do 0.999 later
+    row_clusters = clusterer.newer_cluster_scores(row_score_matrix, score_threshold)
+    col_clusters = clusterer.newer_cluster_scores(col_score_matrix, score_threshold)
 
   # Now translate the clusters of indexes into clusters of boxes
 
@@ -139,63 +94,139 @@ def rate_combinations(boxes, lines):
 
   return (row_cluster_boxes, col_cluster_boxes)
 
-# We may eventually want to take into account the proximity of a line, as this
-# will currently treat a line as infinte, ignoring our endpoints. I think
-# this is okay behavior, as the presence of a line close above (left) still suggests
-# row (col) structure even if offset somewhat
-def calculate_preceding_line_score(edge1, edge2, lines):
-  min_edge = min(edge1, edge2)
-  min_dist = float('inf')
-  min_line = {'border': 0}
-
-  for line in lines:
-    if line['border'] <= min_edge and min_edge - line['border'] < min_dist:
-      min_dist = min_edge - line['border']
-      min_line = line
-
-  # Could also just consider only the minimum, instead of both, but
-  # I think both is probably better, for example in the case of two
-  # With one far away from the other
-  return 1.0 / (1.0 + edge1 - min_line['border'] + edge2 - min_line['border'])
-
-# See the note above (for calculate_preceding_line_score) regarding
-# doing this for segmented lines, possibly
-def calculate_succeeding_line_score(edge1, edge2, lines):
-  max_edge = max(edge1, edge2)
-  min_dist = float('inf')
-  min_line = {'border': 0}
-
-  for line in lines:
-    if line['border'] >= max_edge and max_edge - line['border'] < min_dist:
-      min_dist = max_edge - line['border']
-      min_line = line
-
-  # Could also just consider only the maximum, instead of both, but
-  # I think both is probably better, for example in the case of two
-  # With one far away from the other
-  return 1.0 / (1.0 + min_line['border'] - edge1 + min_line['border'] - edge2)
-
-# Returns percent overlap (length of overlap over min side interval length)
-def calculate_vertical_overlap(box1, box2):
-  inter_len = max(0, min(box1['bottom'], box2['bottom']) - max(box1['top'], box2['top']))
-  min_size = min(box1['bottom'] - box1['top'], box2['bottom'] - box2['top'])
-
-  return inter_len * 1.0 / min_size
-
-# Returns percent overlap (length of overlap over min side interval length)
-def calculate_horizontal_overlap(box1, box2):
-  inter_len = max(0, min(box1['right'], box2['right']) - max(box1['left'], box2['left']))
-  min_size = min(box1['right'] - box1['left'], box2['right'] - box2['left'])
-
-  return inter_len * 1.0 / min_size
-
-def calculate_row_score(scores):
-  score = 0.0
-
-  for score_type in scores:
-    score += scores[score_type]
-
-  return score
-
-def calculate_col_score(scores):
-  return calculate_row_score(scores) # Same for now
+# Returns the boxes as an array of left, top, right, bottom
+def get_box_array(boxes):
+  coords = np.array([box[:4] for box in boxes], dtype=np.float64).reshape(-1, 4)
+
+  return np.column_stack((coords[:, 0], coords[:, 1], coords[:, 0] + coords[:, 2], coords[:, 1] + coords[:, 3]))
+
+def get_sorted_borders(lines):
+  return np.sort(np.array([line['border'] for line in lines], dtype=np.float64))
+
+# Returns the full row and column score matrices as float32 arrays, which
+# are at least the threshold exactly where the float64 scores are
+def get_score_matrices(coords, horiz_borders, vert_borders, threshold):
+  row_score_matrix = np.ones((len(coords), len(coords)), dtype=np.float32)
+  col_score_matrix = np.ones((len(coords), len(coords)), dtype=np.float32)
+
+  for first in range(0, len(coords), score_block_size):
+    last = min(len(coords), first + score_block_size)
+    row_scores, col_scores = get_score_block(coords, first, last, horiz_borders, vert_borders)
+
+    row_score_matrix[first:last] = get_stored_scores(row_scores, threshold)
+    col_score_matrix[first:last] = get_stored_scores(col_scores, threshold)
+
+  # A box always shares a row and column with itself
+  np.fill_diagonal(row_score_matrix, 1.0)
+  np.fill_diagonal(col_score_matrix, 1.0)
+
+  return (row_score_matrix, col_score_matrix)
+
+# Returns the pairs (i < j) whose row and column scores are at least
+# the threshold, as ((row idx_1, row idx_2), (col idx_1, col idx_2)),
+# without holding the full matrices in memory
+def get_score_edges(coords, horiz_borders, vert_borders, threshold):
+  row_edges = ([], [])
+  col_edges = ([], [])
+
+  for first in range(0, len(coords), score_block_size):
+    last = min(len(coords), first + score_block_size)
+    row_scores, col_scores = get_score_block(coords, first, last, horiz_borders, vert_borders)
+
+    for scores, edges in ((row_scores, row_edges), (col_scores, col_edges)):
+      idx_1, idx_2 = np.nonzero(scores >= threshold)
+      idx_1 += first
+      upper = idx_1 < idx_2
+
+      edges[0].append(idx_1[upper])
+      edges[1].append(idx_2[upper])
+
+  return (concat_edges(row_edges), concat_edges(col_edges))
+
+# The scores as float32. A score just under the threshold can round up to
+# it, so those are stored as the largest float32 under it instead.
+def get_stored_scores(scores, threshold):
+  stored = scores.astype(np.float32)
+  limit = np.float32(threshold)
+
+  stored[(scores < threshold) & (stored >= limit)] = np.nextafter(limit, np.float32(-np.inf))
+
+  return stored
+
+def concat_edges(edges):
+  if len(edges[0]) == 0:
+    return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp))
+
+  return (np.concatenate(edges[0]), np.concatenate(edges[1]))
+
+# Scores boxes first:last against every box, for both rows and columns,
+# as float64, so that thresholds are applied before any rounding
+def get_score_block(coords, first, last, horiz_borders, vert_borders):
+  left_1, top_1, right_1, bottom_1 = [x[:, None] for x in coords[first:last].T]
+  left_2, top_2, right_2, bottom_2 = coords.T
+
+  with np.errstate(divide='ignore', invalid='ignore'):
+    # 1.) Their vertical (horizontal) centers align
+    # May want to cut the factor down to 1.0 to make it a max of 1.0
+    row_scores = 2.0 / (1.0 + np.abs(top_1 + bottom_1 - top_2 - bottom_2))
+    col_scores = 2.0 / (1.0 + np.abs(left_1 + right_1 - left_2 - right_2))
+
+    # 2.) Their left (top) edges align
+    row_scores += 1.0 / (1.0 + np.abs(top_1 - top_2))
+    col_scores += 1.0 / (1.0 + np.abs(left_1 - left_2))
+
+    # 3.) Their right (bottom) edges align
+    row_scores += 1.0 / (1.0 + np.abs(bottom_1 - bottom_2))
+    col_scores += 1.0 / (1.0 + np.abs(right_1 - right_2))
+
+    # 4.) If there is a line close to their left (above them)
+    row_scores += calculate_preceding_line_scores(top_1, top_2, horiz_borders)
+    col_scores += calculate_preceding_line_scores(left_1, left_2, vert_borders)
+
+    # 5.) If there is a line close to their right (below them)
+    row_scores += calculate_succeeding_line_scores(bottom_1, bottom_2, horiz_borders)
+    col_scores += calculate_succeeding_line_scores(right_1, right_2, vert_borders)
+
+    # 6.) They overlap significantly in their horizontal (vertical) range
+    row_scores += calculate_overlaps(top_1, bottom_1, top_2, bottom_2)
+    col_scores += calculate_overlaps(left_1, right_1, left_2, right_2)
+
+  # 7.) I would like to add in a term regarding a shared strong score with a third object
+
+  return (row_scores, col_scores)
+
+# How close the closest line at or before (above or left of) both edges
+# is to them, over sorted borders. Lines are treated as infinite, ignoring
+# their endpoints, as a line close above (left) still suggests row (col)
+# structure even if offset somewhat.
+def calculate_preceding_line_scores(edge1, edge2, borders):
+  min_edge = np.minimum(edge1, edge2)
+
+  # The closest line at or before both edges, or 0 if there isn't one
+  if len(borders) == 0:
+    border = 0
+  else:
+    idx = np.searchsorted(borders, min_edge, side='right') - 1
+    border = np.where(idx >= 0, borders[np.maximum(idx, 0)], 0)
+
+  return 1.0 / (1.0 + edge1 - border + edge2 - border)
+
+# How close a line after (below or right of) both edges is to them, over
+# sorted borders. As it always has, this picks the last line at or after
+# both edges, or 0 if there isn't one, rather than the closest
+def calculate_succeeding_line_scores(edge1, edge2, borders):
+  max_edge = np.maximum(edge1, edge2)
+
+  if len(borders) == 0:
+    border = 0
+  else:
+    border = np.where(borders[-1] >= max_edge, borders[-1], 0)
+
+  return 1.0 / (1.0 + border - edge1 + border - edge2)
+
+# Overlap of the intervals, as a fraction of the shorter one
+def calculate_overlaps(start1, end1, start2, end2):
+  inter_len = np.maximum(0, np.minimum(end1, end2) - np.maximum(start1, start2))
+  min_size = np.minimum(end1 - start1, end2 - start2)
+
+  return inter_len / min_size
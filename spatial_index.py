@@ -0,0 +1,58 @@
+import numpy as np
+from collections import defaultdict
+
+# Returns the pairs of boxes (as index arrays, i < j, in the same order as
+# itertools.combinations) that are within radius pixels of each other,
+# measured between their nearest edges. Boxes are bucketed into a uniform
+# grid, so only boxes in nearby cells are compared, and the number of pairs
+# grows with the number of boxes rather than its square.
+def get_candidate_pairs(boxes, radius):
+  coords = np.array([box[:4] for box in boxes], dtype=np.float64).reshape(-1, 4)
+
+  if len(coords) < 2:
+    return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp))
+
+  # Cells at least as big as a typical box, so most boxes only land in a few
+  cell_size = max(1.0, radius, np.median(coords[:, 2]), np.median(coords[:, 3]))
+
+  left = np.floor(coords[:, 0] / cell_size).astype(int)
+  top = np.floor(coords[:, 1] / cell_size).astype(int)
+  right = np.floor((coords[:, 0] + coords[:, 2]) / cell_size).astype(int)
+  bottom = np.floor((coords[:, 1] + coords[:, 3]) / cell_size).astype(int)
+
+  grid = defaultdict(list)
+
+  for i in range(len(coords)):
+    for cx in range(left[i], right[i] + 1):
+      for cy in range(top[i], bottom[i] + 1):
+        grid[(cx, cy)].append(i)
+
+  # Then look up each box with its extent grown by the radius
+  reach = int(np.ceil(radius / cell_size))
+  pairs = set()
+
+  for i in range(len(coords)):
+    for cx in range(left[i] - reach, right[i] + reach + 1):
+      for cy in range(top[i] - reach, bottom[i] + reach + 1):
+        for j in grid.get((cx, cy), ()):
+          if j > i:
+            pairs.add((i, j))
+
+  if len(pairs) == 0:
+    return (np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp))
+
+  pairs = np.array(sorted(pairs), dtype=np.intp)
+  idx_1 = pairs[:, 0]
+  idx_2 = pairs[:, 1]
+
+  # The grid only narrows it down, so check the actual distance
+  within = get_gap_distances(coords[idx_1], coords[idx_2]) <= radius
+
+  return (idx_1[within], idx_2[within])
+
+# Distance between the closest edges of each pair of boxes (0 if they overlap)
+def get_gap_distances(box_1, box_2):
+  horiz_dist = np.maximum(0, np.maximum(box_1[:, 0], box_2[:, 0]) - np.minimum(box_1[:, 0] + box_1[:, 2], box_2[:, 0] + box_2[:, 2]))
+  vert_dist = np.maximum(0, np.maximum(box_1[:, 1], box_2[:, 1]) - np.minimum(box_1[:, 1] + box_1[:, 3], box_2[:, 1] + box_2[:, 3]))
+
+  return np.sqrt(horiz_dist ** 2 + vert_dist ** 2)
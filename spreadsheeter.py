@@ -1,89 +1,187 @@
 import xlsxwriter
 import os
+import re
 import json
 
 import dir_helper
 
+# In batch output, each sheet keeps a temporary file open until the
+# workbook is closed, so batches larger than this go over several workbooks
+max_batch_sheets = 500
+
 def output(rows, cols, boxes, xlsx_path, json_path):
   try:
     os.remove(xlsx_path)
   except OSError:
     pass
 
+  book = None
+
   try:
     dir_helper.ensure(xlsx_path)
-    book = xlsxwriter.Workbook(xlsx_path)
+    book = open_workbook(xlsx_path)
     sheet = book.add_worksheet()
-  
-    indices = {}
-  
-    for i, row in enumerate(rows):
-  
-      for box in row[5]:
-        idx = boxes.index(box)
-        indices[idx] = {}
-  
-        # This could be made more efficient with a default dict
-        if 'rows' not in indices[idx]:
-          indices[idx]['rows'] = []
-
-        indices[idx]['rows'].append(i)
-  
-    for i, col in enumerate(cols):
-      for box in col[5]:
-        idx = boxes.index(box)
-
-        # See note about efficiency above
-        if 'cols' not in indices[idx]:
-          indices[idx]['cols'] = []
-
-        indices[idx]['cols'].append(i)
-
-    cells = [[[] for x in range(len(cols))] for y in range(len(rows))]
-
-    for i,box in enumerate(boxes):
-      sorted_rows = sorted(indices[i]['rows'])
-      sorted_cols = sorted(indices[i]['cols'])
-      for k,row_idx in enumerate(sorted_rows):
-        for j,col_idx in enumerate(sorted_cols):
-          if k == 0 and j == 0:
-            contents = {'type': 'cell', 'contents': box}
-          else:
-            contents = {'type': 'span', 'main_row': sorted_rows[0], 'main_col': sorted_cols[0]}
-
-          cells[row_idx][col_idx].append(contents)
-
-    out_arr = [['' for x in range(len(cols))] for y in range(len(rows))]
-
-    for row_idx, row in enumerate(cells):
-      for col_idx, cell in enumerate(row):
-        overall = []
-        for cell_info in cell:
-          if 'type' not in cell_info:
-            cell_info = {'type': 'unspecified'}
-
-          if cell_info['type'] == 'cell':
-            contents = ' '.join(cell_info['contents'][4])
-          elif cell_info['type'] == 'span':
-            # This can later be a special structure for the json
-            # including for the main cell, too
-            contents = 'SPAN_OF(' + str(cell_info['main_row']) + ', ' + str(cell_info['main_col']) + ')'
-          else:
-            contents = ''
-
-          overall.append(contents)
-
-        display_contents = ' '.join(overall)
-        sheet.write(row_idx, col_idx, display_contents)
-
-        # Store for json output
-        out_arr[row_idx][col_idx] = display_contents
 
     dir_helper.ensure(json_path)
     with open(json_path, 'w') as f:
-      json.dump({'cells': out_arr}, f)
-  
-    # sheet.write(row, col, item)
+      f.write('{"cells": ')
+      write_table(rows, cols, boxes, sheet, f)
+      f.write('}')
 
   finally:
-    book.close()
+    if book is not None:
+      book.close()
+
+# Rows are written out as they're completed, rather than held until the end
+def open_workbook(xlsx_path):
+  return xlsxwriter.Workbook(xlsx_path, {'constant_memory': True})
+
+# Writes the table to the sheet one row at a time, in order, and its cells
+# to json_file as a JSON array of rows, without building the whole grid
+def write_table(rows, cols, boxes, sheet, json_file):
+  # Boxes in the rows and columns are the boxes themselves, so look them up
+  # by identity, falling back on equality for any that are copies. Like
+  # boxes.index, any box equal to an earlier one maps to the earlier one.
+  positions = {}
+  equal_boxes = {}
+
+  for i, box in enumerate(boxes):
+    candidates = equal_boxes.setdefault(tuple(box[:4]), [])
+    first = next((j for j in candidates if boxes[j] == box), None)
+
+    if first is None:
+      candidates.append(i)
+      first = i
+
+    positions.setdefault(id(box), first)
+
+  def get_position(box):
+    return positions[id(box)] if id(box) in positions else boxes.index(box)
+
+  # Only a box's last row is kept, as it always has been
+  box_rows = {}
+
+  for i, row in enumerate(rows):
+    for box in row[5]:
+      box_rows[get_position(box)] = [i]
+
+  box_cols = {}
+
+  for i, col in enumerate(cols):
+    for box in col[5]:
+      box_cols.setdefault(get_position(box), []).append(i)
+
+  # The contents of each (row, col) cell, from each box covering it,
+  # grouped by row, and in order of the boxes within each cell
+  row_cells = {}
+
+  for i, box in enumerate(boxes):
+    sorted_rows = sorted(box_rows.get(i, []))
+    sorted_cols = sorted(box_cols.get(i, []))
+
+    for k, row_idx in enumerate(sorted_rows):
+      for j, col_idx in enumerate(sorted_cols):
+        if k == 0 and j == 0:
+          contents = ' '.join(box[4])
+        else:
+          # This can later be a special structure for the json
+          # including for the main cell, too
+          contents = 'SPAN_OF(' + str(sorted_rows[0]) + ', ' + str(sorted_cols[0]) + ')'
+
+        row_cells.setdefault(row_idx, {}).setdefault(col_idx, []).append(contents)
+
+  json_file.write('[')
+
+  for row_idx in range(len(rows)):
+    cells = row_cells.pop(row_idx, {})
+    out_row = [''] * len(cols)
+
+    for col_idx in sorted(cells):
+      display_contents = ' '.join(cells[col_idx])
+      sheet.write(row_idx, col_idx, display_contents)
+
+      # Store for json output
+      out_row[col_idx] = display_contents
+
+    if row_idx > 0:
+      json_file.write(', ')
+
+    json_file.write(json.dumps(out_row))
+
+  json_file.write(']')
+
+# Writes the tables of many images into one workbook, with a sheet for each,
+# and one JSON Lines file, with a line for each, opening each file once
+class BatchOutput:
+  def __init__(self, xlsx_path, jsonl_path):
+    self.xlsx_path = xlsx_path
+    self.book = None
+    self.book_count = 0
+    self.sheet_count = 0
+    self.sheet_names = set()
+
+    dir_helper.ensure(jsonl_path)
+    self.json_file = open(jsonl_path, 'w')
+
+  def add(self, image, rows, cols, boxes):
+    if self.book is None or self.sheet_count >= max_batch_sheets:
+      self.next_workbook()
+
+    sheet = self.book.add_worksheet(get_sheet_name(image, self.sheet_names))
+    self.sheet_count += 1
+
+    self.json_file.write('{"image": ' + json.dumps(image) + ', "cells": ')
+    write_table(rows, cols, boxes, sheet, self.json_file)
+    self.json_file.write('}\n')
+
+  def next_workbook(self):
+    if self.book is not None:
+      self.book.close()
+
+    self.book_count += 1
+    self.sheet_count = 0
+    self.sheet_names = set()
+
+    # The first workbook is at xlsx_path, any later ones numbered after it
+    if self.book_count == 1:
+      path = self.xlsx_path
+    else:
+      base, ext = os.path.splitext(self.xlsx_path)
+      path = base + '_' + str(self.book_count) + ext
+
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+    dir_helper.ensure(path)
+    self.book = open_workbook(path)
+
+  def close(self):
+    try:
+      if self.book is not None:
+        self.book.close()
+    finally:
+      self.json_file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+# Sheet names are at most 31 characters, can't contain []:*?/\, and
+# must be unique (ignoring case) within the workbook
+def get_sheet_name(image, used):
+  base = re.sub(r'[\[\]:*?/\\]', '_', image)[:31] or 'Sheet'
+  name = base
+  count = 1
+
+  while name.lower() in used:
+    count += 1
+    suffix = '_' + str(count)
+    name = base[:31 - len(suffix)] + suffix
+
+  used.add(name.lower())
+
+  return name
@@ -0,0 +1,40 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import dir_helper
+import ocr_replay
+
+class DefaultRecordingPathTest(unittest.TestCase):
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.tmp = tempfile.mkdtemp()
+    os.chdir(self.tmp)
+
+  def tearDown(self):
+    if ocr_replay.recording is not None:
+      ocr_replay.recording.close()
+      ocr_replay.recording = None
+
+    os.chdir(self.cwd)
+    shutil.rmtree(self.tmp)
+
+  def test_ensure_with_no_directory(self):
+    dir_helper.ensure('ocr_recording.sqlite')
+
+  def test_record_and_read_at_default_path(self):
+    self.assertEqual(ocr_replay.recording_path, 'ocr_recording.sqlite')
+
+    ocr_replay.record('oxford', '/vision/v1/ocr', b'image', 200, b'{"regions": []}')
+
+    saved = ocr_replay.get_recording().get(ocr_replay.get_key('oxford', '/vision/v1/ocr', b'image'))
+
+    self.assertEqual(saved, {'status': 200, 'body': '{"regions": []}'})
+    self.assertTrue(os.path.isfile('ocr_recording.sqlite'))
+
+if __name__ == '__main__':
+  unittest.main()